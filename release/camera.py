@@ -0,0 +1,99 @@
+import numpy as np
+
+from student import project_impl
+
+
+def _frozen(array):
+    array = np.array(array, dtype=np.float64)
+    array.setflags(write=False)
+    return array
+
+
+class Camera(object):
+    """
+    An immutable calibrated camera.  The intrinsics K and extrinsics Rt are
+    copied into read-only float64 arrays, and everything derived from them
+    is computed once up front:
+
+        P -- 3 x 4 projection matrix K Rt
+        K_inv -- inverse intrinsics
+        R, t -- rotation and translation of Rt
+        R_T -- transposed rotation, i.e. camera to world
+        center -- camera center in world coordinates, -R^T t
+
+    scaled(levels) gives the same camera for an image that went through
+    `levels` pyrdown steps.  The scaled copies are cached, so every pyramid
+    level is built once no matter how often it is asked for.
+    """
+
+    __slots__ = ('K', 'Rt', 'P', 'K_inv', 'R', 't', 'R_T', 'center',
+                 '_scaled')
+
+    def __init__(self, K, Rt):
+        K = _frozen(K)
+        Rt = _frozen(Rt)
+        assert K.shape == (3, 3) and Rt.shape == (3, 4)
+
+        R_T = _frozen(Rt[:, :3].T)
+        values = {
+            'K': K,
+            'Rt': Rt,
+            'P': _frozen(K.dot(Rt)),
+            'K_inv': _frozen(np.linalg.inv(K)),
+            'R': Rt[:, :3],
+            't': Rt[:, 3],
+            'R_T': R_T,
+            'center': _frozen(-R_T.dot(Rt[:, 3])),
+            '_scaled': {},
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+        self._scaled[0] = self
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Camera is immutable')
+
+    def __repr__(self):
+        return 'Camera(K={0!r}, Rt={1!r})'.format(self.K.tolist(),
+                                                   self.Rt.tolist())
+
+    def scaled(self, levels):
+        """
+        This camera with the intrinsics halved `levels` times, to match an
+        image after that many pyrdown steps.
+        """
+        if levels not in self._scaled:
+            K = self.K.copy()
+            K[:2, :] /= 2 ** levels
+            self._scaled[levels] = Camera(K, self.Rt)
+        return self._scaled[levels]
+
+    def project(self, points):
+        """
+        Project ... x 3 world points to ... x 2 pixels with
+        student.project_impl, including its rule for points behind the
+        camera.
+        """
+        return project_impl(self.K, self.Rt, points)
+
+    def unproject(self, pixels, depth):
+        """
+        World points at the given depth for ... x 2 pixel coordinates.  depth
+        is a scalar or broadcasts against the leading shape of pixels.
+        """
+        pixels = np.asarray(pixels, dtype=np.float64)
+        rays = np.einsum('ij,...j->...i', self.K_inv[:, :2], pixels) + \
+            self.K_inv[:, 2]
+        rays = rays * np.asarray(depth)[..., np.newaxis]
+        return np.einsum('ij,...j->...i', self.R_T, rays) + self.center
+
+    def unproject_corners(self, width, height, depth):
+        """
+        The corners of the image plane at depth, arranged as in
+        student.unproject_corners_impl.  With an array of depths the result
+        has shape depths.shape + (2, 2, 3).
+        """
+        corners = np.array(((0., 0.), (width, 0.), (0., height),
+                            (width, height))).reshape(2, 2, 2)
+        depth = np.asarray(depth, dtype=np.float64)
+        return self.unproject(corners, depth[..., np.newaxis, np.newaxis])
@@ -1,36 +1,66 @@
+import argparse
 import numpy as np
-import sys
 import math
 
 from imageio import imwrite, imread
-from scipy.sparse.linalg import lsqr
 import cv2
 import time
 
-from util import pyrup, save_mesh, form_poisson_equation, pyrdown
+from util import pyrup, save_mesh, form_poisson_equation, pyrdown, \
+    form_poisson_operator
+
+from camera import Camera
+
+from solvers import SOLVERS, MATRIX_FREE, integrate_normals_dct
 
 from dataset import load_dataset
 
-assert len(sys.argv) > 2
-data = load_dataset(sys.argv[1])
-mode = sys.argv[2]
-assert mode in ('normals', 'depth', 'both')
+parser = argparse.ArgumentParser()
+parser.add_argument('dataset')
+parser.add_argument('mode', choices=('normals', 'depth', 'both'))
+parser.add_argument('--solver', choices=sorted(SOLVERS) + ['dct'],
+                    default=None,
+                    help='least squares solver for the depth integration; '
+                         'dct integrates normals over a full mask without '
+                         'a sparse system.  Defaults to dct where it '
+                         'applies and lsqr otherwise')
+parser.add_argument('--tol', type=float, default=None,
+                    help="stopping tolerance, defaults to the solver's own")
+parser.add_argument('--maxiter', type=int, default=None,
+                    help='iteration limit for the iterative solvers')
+parser.add_argument('--matrix-free', action='store_true',
+                    help='apply the system with array slicing instead of '
+                         'building a sparse matrix; works with ' +
+                         ', '.join(MATRIX_FREE))
+parser.add_argument('--binary-ply', action='store_true',
+                    help='write the mesh as binary_little_endian PLY')
+parser.add_argument('--triangles', action='store_true',
+                    help='split every quad of the mesh into two triangles')
+parser.add_argument('--warm-start', action='store_true',
+                    help='start iterative solvers from the stereo depth '
+                         'instead of zero')
+args = parser.parse_args()
+
+data = load_dataset(args.dataset)
+mode = args.mode
 
 alpha = data.right_alpha
 depth_weight = None
 depth = None
-K_right = None
+camera = None
 normals = None
 albedo = None
 
 tic = time.time()
 if mode in ('normals', 'both'):
-    albedo = imread(data.albedo_png)
+    # Grayscale albedo is saved with a single channel.
+    albedo = np.atleast_3d(imread(data.albedo_png))
     normals = np.load(data.normals_npy)
 
 if mode in ('depth', 'both'):
     depth = np.load(data.depth_npy)
-    K_right = data.K_right
+    camera = Camera(data.K_right, data.Rt_right).scaled(
+        data.mesh_downscale_factor)
 
     depth = cv2.medianBlur(depth, 5)
     depth = cv2.medianBlur(depth, 5)
@@ -49,9 +79,6 @@ if mode in ('depth', 'both'):
             y = pyrup(x)
             depth = y[:, :, 0]
 
-    for i in range(data.mesh_downscale_factor):
-        K_right[:2, :] /= 2
-
 if mode == 'both':
     depth_weight = data.depth_weight
 
@@ -104,22 +131,49 @@ if normals is not None:
 
 print('Initialized data in {0} seconds'.format(toc - tic))
 
-tic = time.time()
-A, b = form_poisson_equation(
-    height, width, alpha, normals, depth_weight, depth)
-toc = time.time()
-
-print('Set up linear system in {0} seconds'.format(toc - tic))
-
-tic = time.time()
-print('Solving...')
-solution = lsqr(A, b)
-x = solution[0]
-depth = x.reshape(height, width)
-toc = time.time()
-print('Solve complete in {0} seconds'.format(toc - tic))
+"""
+Normals over the full image rectangle can be integrated spectrally.
+Anything else, or a mask with holes, goes through the sparse system.
+"""
+spectral = mode == 'normals' and (alpha is None or (alpha != 0).all())
+solver = args.solver
+if solver is None:
+    solver = 'dct' if spectral else 'lsqr'
+elif solver == 'dct' and not spectral:
+    print('The dct solver needs normals and a full mask, using lsqr')
+    solver = 'lsqr'
+if args.matrix_free and solver != 'dct' and solver not in MATRIX_FREE:
+    parser.error('--matrix-free does not work with the {0} solver'
+                 .format(solver))
+
+if solver == 'dct':
+    print('Solving with dct...')
+    solution = integrate_normals_dct(normals)
+else:
+    tic = time.time()
+    if args.matrix_free:
+        A, b = form_poisson_operator(
+            height, width, alpha, normals, depth_weight, depth)
+    else:
+        A, b = form_poisson_equation(
+            height, width, alpha, normals, depth_weight, depth)
+    toc = time.time()
+
+    print('Set up linear system in {0} seconds'.format(toc - tic))
+
+    x0 = None
+    if args.warm_start and depth is not None:
+        x0 = np.float64(depth).ravel()
+
+    print('Solving with {0}...'.format(solver))
+    solution = SOLVERS[solver](A, b, x0=x0, tol=args.tol,
+                               maxiter=args.maxiter, shape=(height, width))
+depth = solution.x.reshape(height, width)
+print('Solve complete in {0} seconds after {1} iterations, residual '
+      '{2}'.format(solution.seconds, solution.iterations, solution.residual))
 
 print( 'Save mesh to {0}'.format(data.mesh_ply.format(mode)))
-save_mesh(K_right, width, height, albedo, normals,
-          depth, alpha, data.mesh_ply.format(mode))
+save_mesh(camera, width, height, albedo, normals,
+          depth, alpha, data.mesh_ply.format(mode), binary=args.binary_ply,
+          triangles=args.triangles)
 print ('done :)')
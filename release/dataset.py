@@ -33,6 +33,8 @@ class TentacleDataset(object):
         self.normals_npy = 'output/tentacle_normals.npy'
         self.ncc_png = 'output/tentacle_ncc.png'
         self.depth_npy = 'output/tentacle_depth.npy'
+        self.confidence_npy = 'output/tentacle_confidence.npy'
+        self.profile_json = 'output/tentacle_profile.json'
         self.mesh_ply = 'output/tentacle_mesh_{0}.ply'
 
         self.ncc_temp = 'temp/tentacle_ncc-%03d.png'
@@ -147,13 +149,14 @@ class PSDataset(object):
         self.mesh_downscale_factor = 1
         self.stereo_downscale_factor = 0
 
+        # The views are grayscale, so keep them as single channel images
+        # rather than three identical copies.
         self.right = [
-            np.dstack(3 * [
-                np.float32(
-                    imread(
-                        os.path.join('data', 'PSData', name, 'Objects',
-                                     'Image_%02d.png' % (i + 1))
-                    ))[:, :, np.newaxis]])
+            np.float32(
+                imread(
+                    os.path.join('data', 'PSData', name, 'Objects',
+                                 'Image_%02d.png' % (i + 1))
+                ))[:, :, np.newaxis]
             for i in range(num_views)
         ]
 
@@ -163,7 +166,7 @@ class PSDataset(object):
         self.right_alpha = np.ones((self.height, self.width), dtype=np.float32)
 
         for image in self.right:
-            assert image.shape == (self.height, self.width, 3)
+            assert image.shape == (self.height, self.width, 1)
 
         self.lights = np.loadtxt(
             os.path.join('data', 'PSData', name, 'light_directions.txt'))
@@ -176,6 +179,8 @@ class MiddleburyDataset(object):
 
         self.ncc_png = 'output/{0}_ncc.png'.format(name)
         self.depth_npy = 'output/{0}_depth.npy'.format(name)
+        self.confidence_npy = 'output/{0}_confidence.npy'.format(name)
+        self.profile_json = 'output/{0}_profile.json'.format(name)
 
         self.ncc_temp = 'temp/{0}_ncc-%03d.png'.format(name)
         self.ncc_gif = 'output/{0}_ncc.gif'.format(name)
@@ -1,7 +1,12 @@
 import subprocess
 import os
 import platform
+import queue
+import threading
 
+import cv2
+import imageio
+import numpy as np
 from imageio import imwrite
 
 
@@ -38,3 +43,113 @@ class GifWriter(object):
         for filename in self.temp_filenames:
             os.unlink(filename)
         self.closed = True
+
+
+class StreamingGifWriter(object):
+    """
+    In-process drop-in for GifWriter.  Frames go straight to an animated
+    image encoder, with no temp PNGs and no ImageMagick.  The format follows
+    the extension of dest: .gif, .apng for an animated PNG, or .npz for the
+    raw uint8 frame stack.
+
+    Only one frame out of every `every` is kept, and kept frames are shrunk
+    by `scale` in each dimension, to bound the size of the output.
+    """
+
+    formats = ('.gif', '.apng', '.npz')
+
+    def __init__(self, dest, every=1, scale=1, delay=20):
+        self.dest = dest
+        self.extension = os.path.splitext(dest)[1].lower()
+        if self.extension not in self.formats:
+            raise Exception('{0} is not one of {1}'.format(
+                dest, ', '.join(self.formats)))
+
+        self.every = every
+        self.scale = scale
+        self.delay = delay
+        self.count = 0
+        self.frames = []
+        self.writer = None
+        self.closed = False
+
+    def append(self, image):
+        if self.closed:
+            raise Exception('GifWriter is already closed')
+        keep = self.count % self.every == 0
+        self.count += 1
+        if not keep:
+            return
+
+        if self.scale > 1:
+            height, width = image.shape[:2]
+            size = (max(1, width // self.scale), max(1, height // self.scale))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+        if self.extension == '.npz':
+            self.frames.append(image)
+            return
+
+        if self.writer is None:
+            # duration is the per-frame delay in milliseconds, matching
+            # GifWriter's -delay 2.
+            self.writer = imageio.get_writer(self.dest, mode='I',
+                                             duration=self.delay, loop=0)
+        self.writer.append_data(image)
+
+    def close(self):
+        if self.extension == '.npz':
+            np.savez_compressed(self.dest, frames=np.array(self.frames))
+        elif self.writer is not None:
+            self.writer.close()
+        self.closed = True
+
+
+class AsyncGifWriter(object):
+    """
+    Wraps a GifWriter so that frames are encoded and written on a background
+    thread.  append only hands the frame to a bounded queue; it waits only
+    when the writer has fallen max_pending frames behind, which bounds the
+    memory held by queued frames.
+
+    Frames are not copied, so callers must not modify them after append.
+    """
+
+    _done = object()
+
+    def __init__(self, writer, max_pending=16):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            image = self.queue.get()
+            if image is self._done:
+                return
+            if self.error is None:
+                try:
+                    self.writer.append(image)
+                except Exception as exc:
+                    self.error = exc
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def append(self, image):
+        if self.closed:
+            raise Exception('GifWriter is already closed')
+        self._raise_error()
+        self.queue.put(image)
+
+    def close(self):
+        self.queue.put(self._done)
+        self.thread.join()
+        self.closed = True
+        self._raise_error()
+        self.writer.close()
@@ -0,0 +1,192 @@
+import sys
+import time
+
+import cv2
+import numpy as np
+from scipy import ndimage
+
+from util import pyrdown, sweep_layer, compute_homographies, \
+    NCC_ENGINES, StreamingArgmax
+from timing import stage
+from camera import Camera
+
+
+def _pyramid(left, right, left_camera, right_camera, levels):
+    """
+    Build image pyramids for both views, finest level first, along with
+    the intrinsics scaled to match every level.
+    """
+    pyramid = [(left, right, left_camera.K, right_camera.K)]
+    for i in range(1, levels):
+        left = pyrdown(left)
+        right = pyrdown(right)
+        pyramid.append((left, right, left_camera.scaled(i).K,
+                        right_camera.scaled(i).K))
+    return pyramid
+
+
+def _upsample_labels(labels, best, height, width):
+    """
+    Upsample a coarse label map to the next finer level.  Pixels that scored
+    nothing at the coarse level (the image border and flat regions) first
+    borrow the label of the nearest pixel that did.
+    """
+    valid = best > 0
+    if valid.any() and not valid.all():
+        _, (rows, cols) = ndimage.distance_transform_edt(
+            ~valid, return_indices=True)
+        labels = labels[rows, cols]
+
+    labels = np.repeat(np.repeat(labels, 2, axis=0), 2, axis=1)
+    return labels[:height, :width]
+
+
+def _normalize_patches(patches):
+    """
+    In-place NCC normalization of n x channels x ncc_size**2 patches, with
+    the same per-channel mean and joint norm as preprocess_ncc.
+    """
+    patches -= patches.mean(axis=2, keepdims=True)
+    norm = np.sqrt(np.einsum('ijk,ijk->i', patches, patches))
+    norm[norm < 1e-6] = np.inf
+    patches /= norm[:, np.newaxis, np.newaxis]
+    return patches
+
+
+def _refine(left, right, depths, centers, K_left, Rt_left, K_right,
+            Rt_right, ncc_size, band, chunk):
+    """
+    Test only the labels within band of centers at every pixel.  Instead of
+    warping the whole left image once per depth, each pixel's patch is
+    sampled directly through the inverse homography of the label under
+    test, so every pixel costs exactly 2 * band + 1 NCC evaluations.
+
+    Pixels are processed in chunks to bound the size of the patch buffers.
+    """
+    height, width, channels = right.shape
+    half = ncc_size // 2
+    area = ncc_size * ncc_size
+
+    # Homographies map left pixels to right pixels, so their inverses give
+    # the left sampling location for every right pixel, as in
+    # cv2.warpPerspective.
+    inverse = np.linalg.inv(
+        compute_homographies(K_left, Rt_left, K_right, Rt_right, depths))
+
+    offsets = np.arange(-half, half + 1)
+    dy, dx = np.meshgrid(offsets, offsets, indexing='ij')
+    patch = np.stack((dx.ravel(), dy.ravel(), np.zeros(area)), axis=1)
+
+    # Patches that cross the border score zero everywhere, which argmax
+    # resolves to the first label.
+    labels = np.zeros((height, width), dtype=np.int64)
+    best = np.zeros((height, width), dtype=np.float32)
+    if height < ncc_size or width < ncc_size:
+        return labels, best, 0
+
+    windows = np.lib.stride_tricks.sliding_window_view(
+        right, (ncc_size, ncc_size), axis=(0, 1))
+    ys, xs = np.mgrid[half:height - half, half:width - half]
+    ys = ys.ravel()
+    xs = xs.ravel()
+
+    for start in range(0, len(ys), chunk):
+        y = ys[start:start + chunk]
+        x = xs[start:start + chunk]
+        n = len(y)
+
+        right_patches = _normalize_patches(np.float32(
+            windows[y - half, x - half].reshape(n, channels, area)))
+        points = patch[np.newaxis] + \
+            np.stack((x, y, np.ones(n)), axis=1)[:, np.newaxis]
+
+        center = centers[y, x]
+        chunk_best = np.full(n, -np.inf, dtype=np.float32)
+        chunk_labels = center.copy()
+
+        for offset in range(-band, band + 1):
+            label = center + offset
+            in_range = (label >= 0) & (label < len(depths))
+            label = np.clip(label, 0, len(depths) - 1)
+
+            mapped = np.einsum('nij,nkj->nki', inverse[label], points)
+            map_x = np.float32(mapped[:, :, 0] / mapped[:, :, 2])
+            map_y = np.float32(mapped[:, :, 1] / mapped[:, :, 2])
+            samples = cv2.remap(left, map_x, map_y, cv2.INTER_LINEAR)
+
+            left_patches = _normalize_patches(np.ascontiguousarray(
+                samples.reshape(n, area, channels).transpose(0, 2, 1)))
+            score = np.einsum('ijk,ijk->i', right_patches, left_patches)
+
+            better = in_range & (score > chunk_best)
+            chunk_best[better] = score[better]
+            chunk_labels[better] = label[better]
+
+        best[y, x] = chunk_best
+        labels[y, x] = chunk_labels
+
+    return labels, best, len(ys) * (2 * band + 1)
+
+
+def hierarchical_plane_sweep(left, right, depths, K_left, Rt_left, K_right,
+                             Rt_right, ncc_size, levels=3, band=4,
+                             engine='patch', chunk=16384, timer=None,
+                             verbose=False):
+    """
+    Coarse-to-fine plane sweep.  The full depth range is swept at the
+    coarsest of `levels` pyramid levels.  Every finer level then only tests
+    the labels within `band` of the upsampled coarse winner, so the number
+    of (pixel, depth) NCC evaluations at those levels drops from
+    len(depths) to 2 * band + 1 per pixel.
+
+    `engine` selects the NCC engine for the coarse sweep.  The refinement
+    samples patches directly and matches the patch engine.  Stage timings go
+    to timer, if given, and progress to stdout with verbose.
+
+    Input:
+        left, right -- height x width x channels images at the finest level
+        depths -- depth of every label
+        K_left, Rt_left, K_right, Rt_right -- calibration for the finest
+                                              level
+    Output:
+        labels -- height x width array of depth labels
+        best -- height x width NCC score of the chosen labels
+        evaluations -- number of (pixel, depth) pairs scored
+    """
+    preprocess, _ = NCC_ENGINES[engine]
+    pyramid = _pyramid(left, right, Camera(K_left, Rt_left),
+                       Camera(K_right, Rt_right), levels)
+
+    left, right, K_left_level, K_right_level = pyramid[-1]
+    height, width = right.shape[:2]
+    right_normalized = preprocess(right, ncc_size)
+
+    with stage(timer, 'homography', height * width * len(depths)):
+        homographies = compute_homographies(K_left_level, Rt_left,
+                                            K_right_level, Rt_right, depths)
+    running = StreamingArgmax(height, width)
+    for pos, H in enumerate(homographies):
+        _, ncc = sweep_layer(left, right_normalized, H, width, height,
+                             ncc_size, engine, timer)
+        running.update(pos, ncc)
+    labels, best = running.label, running.best
+    evaluations = height * width * len(depths)
+
+    for level in range(levels - 2, -1, -1):
+        left, right, K_left_level, K_right_level = pyramid[level]
+        height, width = right.shape[:2]
+
+        if verbose:
+            sys.stdout.write('Refining level {0}\r'.format(level))
+            sys.stdout.flush()
+
+        centers = _upsample_labels(labels, best, height, width)
+        tic = time.perf_counter()
+        labels, best, count = _refine(
+            left, right, depths, centers, K_left_level, Rt_left,
+            K_right_level, Rt_right, ncc_size, band, chunk)
+        if timer is not None:
+            timer.add('refine', time.perf_counter() - tic, 1, count)
+        evaluations += count
+
+    return labels, best, evaluations
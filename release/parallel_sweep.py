@@ -0,0 +1,154 @@
+import multiprocessing
+import os
+import sys
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from util import sweep_layer
+from timing import StageTimer
+
+
+# Per-process state filled in by _init_worker.  The shared memory handles
+# are kept here so that the numpy views built on top of them stay valid.
+_worker = {}
+
+
+def _share(array):
+    """
+    Copy an array into a new shared memory block.  Returns the block and a
+    picklable description that workers use to attach to it.
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    _worker.setdefault('blocks', []).append(shm)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _share_normalized(normalized, blocks):
+    """
+    Share the normalized right image.  This is either a plain array or, for
+    the box engine, a namedtuple whose array fields are shared one by one.
+    """
+    if isinstance(normalized, np.ndarray):
+        shm, spec = _share(normalized)
+        blocks.append(shm)
+        return spec
+
+    fields = []
+    for value in normalized:
+        if isinstance(value, np.ndarray):
+            shm, spec = _share(value)
+            blocks.append(shm)
+            fields.append(('array', spec))
+        else:
+            fields.append(('value', value))
+    return type(normalized), fields
+
+
+def _attach_normalized(spec):
+    if not isinstance(spec[1], list):
+        return _attach(spec)
+
+    kind, fields = spec
+    return kind(*[_attach(value) if tag == 'array' else value
+                  for tag, value in fields])
+
+
+def _init_worker(left_spec, right_spec, volume_spec, geometry, engine,
+                 profile):
+    # Each worker is single threaded; the pool provides the parallelism.
+    cv2.setNumThreads(1)
+
+    _worker['left'] = _attach(left_spec)
+    _worker['right_normalized'] = _attach_normalized(right_spec)
+    _worker['volume'] = _attach(volume_spec)
+    _worker['geometry'] = geometry
+    _worker['engine'] = engine
+    _worker['profile'] = profile
+
+
+def _sweep_chunk(chunk):
+    width, height, ncc_size = _worker['geometry']
+    volume = _worker['volume']
+    timer = StageTimer() if _worker['profile'] else None
+
+    for pos, H in chunk:
+        _, ncc = sweep_layer(_worker['left'], _worker['right_normalized'], H,
+                             width, height, ncc_size, _worker['engine'],
+                             timer)
+        volume[pos] = ncc
+
+    return len(chunk), timer.stages if timer is not None else None
+
+
+def parallel_plane_sweep(left, right_normalized, homographies, width, height,
+                         ncc_size, engine='patch', workers=None, timer=None,
+                         verbose=False):
+    """
+    Run the plane sweep over the planes given by homographies on a pool of
+    worker processes.
+
+    left, right_normalized and the output cost volume live in shared memory,
+    so workers read their inputs and write their NCC layers in place
+    instead of pickling images back and forth.  The depth list is split
+    into contiguous chunks, several per worker to balance the load.  Stage
+    timings from the workers are merged into timer, if given, so they add up
+    CPU time across processes rather than wall-clock time.  With verbose
+    the progress goes to stdout.
+
+    Returns the height x width x len(homographies) float32 cost volume.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+
+    blocks = []
+    try:
+        shm, left_spec = _share(left)
+        blocks.append(shm)
+        right_spec = _share_normalized(right_normalized, blocks)
+
+        volume_shm = shared_memory.SharedMemory(
+            create=True, size=len(homographies) * height * width * 4)
+        blocks.append(volume_shm)
+        volume = np.ndarray((len(homographies), height, width),
+                            dtype=np.float32,
+                            buffer=volume_shm.buf)
+        volume_spec = (volume_shm.name, volume.shape, volume.dtype.str)
+
+        layers = list(enumerate(homographies))
+        chunk_count = min(len(layers), 4 * workers)
+        chunks = [[layers[i] for i in indices] for indices in
+                  np.array_split(np.arange(len(layers)), chunk_count)]
+
+        done = 0
+        with multiprocessing.Pool(workers, _init_worker,
+                          (left_spec, right_spec, volume_spec,
+                           (width, height, ncc_size), engine,
+                           timer is not None)) as pool:
+            for count, stages in pool.imap_unordered(_sweep_chunk, chunks):
+                done += count
+                if stages is not None:
+                    timer.merge(stages)
+                if verbose:
+                    sys.stdout.write('Progress: {0}\r'.format(
+                        int(100 * done / len(layers))))
+                    sys.stdout.flush()
+
+        result = np.moveaxis(volume, 0, 2).copy()
+        # Drop the view so the shared block can be closed.
+        del volume
+        return result
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
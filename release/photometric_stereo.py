@@ -1,6 +1,6 @@
+import argparse
 import numpy as np
 import math
-import sys
 
 from imageio import imwrite
 
@@ -8,17 +8,33 @@ from dataset import load_dataset
 
 from util import compute_photometric_stereo, rerendering_error
 
-assert len(sys.argv) > 1
-data = load_dataset(sys.argv[1])
+parser = argparse.ArgumentParser()
+parser.add_argument('dataset')
+parser.add_argument('--max-memory', type=float, default=None,
+                    help='solve in row bands whose temporaries fit in this '
+                         'many megabytes instead of the whole image at once')
+parser.add_argument('--trim', type=int, default=0,
+                    help='ignore this many of the darkest and of the '
+                         'brightest observations at every pixel, to reject '
+                         'shadows and highlights')
+args = parser.parse_args()
 
-albedo, normals = compute_photometric_stereo(data.lights, data.right)
+data = load_dataset(args.dataset)
+max_bytes = None if args.max_memory is None else args.max_memory * 2 ** 20
 
-avg_rmse = rerendering_error(data.lights, data.right, albedo, normals)
+albedo, normals = compute_photometric_stereo(data.lights, data.right,
+                                             max_bytes, args.trim)
+
+avg_rmse = rerendering_error(data.lights, data.right, albedo, normals,
+                             max_bytes)
 
 print ('Average RMSE of rerendered image is {0}'.format(avg_rmse))
 
 print ('Saving albedo to {0}'.format(data.albedo_png))
-imwrite(data.albedo_png, np.uint8(np.clip(albedo, 0, 255)))
+albedo_image = np.uint8(np.clip(albedo, 0, 255))
+if albedo_image.shape[2] == 1:
+    albedo_image = albedo_image[:, :, 0]
+imwrite(data.albedo_png, albedo_image)
 print ('Saving normals visualization to {0}'.format(data.normals_png))
 imwrite(data.normals_png, normals)
 print ('Saving normals to {0}'.format(data.normals_npy))
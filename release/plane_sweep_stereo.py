@@ -1,128 +1,371 @@
 from imageio import imwrite
-import cv2
+import argparse
+import os
 import numpy as np
 import sys
 import time
+from collections import namedtuple
 
-from util import preprocess_ncc, pyrdown, get_depths, \
-    unproject_corners, compute_ncc, project
+from util import pyrdown, get_depths, sweep_layer, compute_homographies, \
+    rectified_translations, rectified_layer, multi_sweep_layer, NCC_ENGINES, \
+    NCC_AGGREGATES, StreamingArgmax
 
 from dataset import load_dataset
 
-from gifwriter import GifWriter
+from gifwriter import GifWriter, StreamingGifWriter, AsyncGifWriter
 
-assert len(sys.argv) > 1
-data = load_dataset(sys.argv[1])
+from parallel_sweep import parallel_plane_sweep
 
-K_right = data.K_right
-K_left = data.K_left
-Rt_right = data.Rt_right
-Rt_left = data.Rt_left
+from hierarchical_sweep import hierarchical_plane_sweep
 
-ncc_size = data.ncc_size
-width = data.width
-height = data.height
+from timing import StageTimer, stage
 
-ncc_gif_writer = GifWriter(data.ncc_temp, data.ncc_gif)
-projected_gif_writer = GifWriter(data.projected_temp, data.projected_gif)
+from camera import Camera
 
-"""
-Images are pretty large, so we're going to reduce their size
-in each dimension.
-"""
-right = data.right[0]
-left = data.left[0]
-for i in range(data.stereo_downscale_factor):
-    right = pyrdown(right)
-    left = pyrdown(left)
-    height, width, _ = right.shape
-    K_left[:2, :] /= 2
-    K_right[:2, :] /= 2
 
-"""
-We'll give you the depth labels for this problem.
-"""
-depths = get_depths(data)
+SweepResult = namedtuple(
+    'SweepResult', ['labels', 'depth', 'depths', 'volume', 'confidence'])
+
 
-tic = time.time()
+def check_sweep_options(streaming=False, confidence=False, workers=1,
+                        levels=1, rectified=False, return_volume=False,
+                        views=1):
+    """
+    Raise if the requested plane_sweep modes cannot be combined.
+    """
+    if streaming and workers > 1:
+        raise Exception('streaming runs in a single process')
+    if levels > 1 and (workers > 1 or confidence or return_volume):
+        raise Exception('levels > 1 does not support workers, confidence '
+                        'or return_volume')
+    if rectified and (levels > 1 or workers > 1):
+        raise Exception('rectified does not support levels or workers')
+    if streaming and return_volume:
+        raise Exception('streaming does not keep a volume')
+    if views > 1 and (levels > 1 or workers > 1 or rectified):
+        raise Exception('several views do not support levels, workers or '
+                        'rectified')
 
-"""
-The planes will be swept fronto-parallel to the right camera, so no
-reprojection needs to be done for this image.  Simply compute the normalized
-patches across the entire image.
-"""
-right_normalized = preprocess_ncc(right[:, :, :3], ncc_size)
 
-"""
-We'll sweep a series of planes that are fronto-parallel to the right camera.
-The image from the left camera is to be projected onto each of these planes,
-normalized, and then compared to the normalized right image.
-"""
-volume = []
-for pos, depth in enumerate(depths):
+def plane_sweep(data, ncc_size=None, depths=None, downscale=None,
+                engine='patch', streaming=False, confidence=False, workers=1,
+                levels=1, band=4, rectified=False, return_volume=False,
+                views=None, aggregate='mean', ncc_gif_writer=None,
+                projected_gif_writer=None, timer=None, verbose=False):
     """
-    Unproject the pixel coordinates from the right camera onto the virtual
-    plane.
+    Plane sweep stereo between data.left[0] and data.right[0], or between
+    several left/right pairs at once, see views.  The dataset is only read
+    from, so decoded datasets can be reused across many calls.
+
+    Input:
+        data -- a dataset from load_dataset
+        ncc_size -- NCC patch size, defaults to data.ncc_size
+        depths -- depths to sweep, defaults to get_depths(data)
+        downscale -- number of pyrdown steps applied to both images first,
+                     defaults to data.stereo_downscale_factor
+        engine -- NCC engine, a key of util.NCC_ENGINES
+        streaming -- keep a running argmax instead of the cost volume
+        confidence -- also return the best minus second-best NCC margin
+        workers -- number of processes for the sweep
+        levels, band -- coarse-to-fine sweep over this many pyramid levels,
+                        testing band labels either side of the coarse winner
+        rectified -- sweep integer disparities on a rectified pair
+        return_volume -- also return the height x width x D cost volume
+        views -- indices of the data.left / data.right pairs to score every
+                 depth against, defaults to [0].  With several views, e.g.
+                 every lighting of the Tentacle, their NCC maps are combined
+                 with util.aggregate_ncc.
+        aggregate -- 'mean' or 'trimmed', see util.aggregate_ncc
+        ncc_gif_writer, projected_gif_writer -- optional frame writers for
+                                                the per-layer diagnostics
+        timer -- optional timing.StageTimer
+        verbose -- write progress and timings to stdout
+    Output:
+        SweepResult with the label map, the depth map, the depth of every
+        label and, when requested, the volume and confidence (else None).
     """
-    points = unproject_corners(K_right, width, height, depth, Rt_right)
+    if views is None:
+        views = [0]
+    check_sweep_options(streaming, confidence, workers, levels, rectified,
+                        return_volume, len(views))
+    if aggregate not in NCC_AGGREGATES:
+        raise Exception('{0} is not a valid aggregate'.format(aggregate))
+
+    if ncc_size is None:
+        ncc_size = data.ncc_size
+    if depths is None:
+        depths = get_depths(data)
+    depths = np.asarray(depths, dtype=np.float32)
+    if downscale is None:
+        downscale = data.stereo_downscale_factor
+
+    preprocess_ncc, _ = NCC_ENGINES[engine]
+
+    left_camera = Camera(data.K_left, data.Rt_left).scaled(downscale)
+    right_camera = Camera(data.K_right, data.Rt_right).scaled(downscale)
+    K_left, Rt_left = left_camera.K, left_camera.Rt
+    K_right, Rt_right = right_camera.K, right_camera.Rt
 
     """
-    Project those points onto the two cameras to generate correspondences.
+    Images are pretty large, so we're going to reduce their size
+    in each dimension.
     """
-    points_left = project(K_left, Rt_left, points)
-    points_right = project(K_right, Rt_right, points)
+    rights = [data.right[i][:, :, :3] for i in views]
+    lefts = [data.left[i] for i in views]
+    for i in range(downscale):
+        rights = [pyrdown(right) for right in rights]
+        lefts = [pyrdown(left) for left in lefts]
+    right = rights[0]
+    left = lefts[0]
+    height, width, _ = right.shape
 
-    points_left = np.float32(points_left.reshape(-1, 2))
-    points_right = np.float32(points_right.reshape(-1, 2))
+    tic = time.time()
 
-    H, mask = cv2.findHomography(points_left, points_right)
-    assert (mask == 1).all()
+    if levels > 1:
+        labels, _, evaluations = hierarchical_plane_sweep(
+            left, right, depths, K_left, Rt_left, K_right, Rt_right,
+            ncc_size, levels, band, engine, timer=timer, verbose=verbose)
+        if verbose:
+            print ('Scored {0:.1f}x fewer (pixel, depth) pairs than a full '
+                   'sweep'.format(height * width * len(depths) /
+                                  float(evaluations)))
+            print ('Plane sweep took {0} seconds'.format(time.time() - tic))
+        return SweepResult(labels, depths[labels], depths, None, None)
 
-    projected_left = cv2.warpPerspective(left, H, (width, height))
+    """
+    The planes will be swept fronto-parallel to the right camera, so no
+    reprojection needs to be done for this image.  Simply compute the
+    normalized patches across the entire image.
+    """
+    with stage(timer, 'preprocess', height * width * len(views)):
+        rights_normalized = [preprocess_ncc(image, ncc_size)
+                             for image in rights]
+    right_normalized = rights_normalized[0]
 
     """
-    Normalize this projected left image.
+    Every plane induces a homography between the two views.  These are
+    computed in closed form for all depths at once.
     """
-    left_normalized = preprocess_ncc(projected_left, ncc_size)
+    with stage(timer, 'homography', height * width * len(depths)):
+        homographies = compute_homographies(K_left, Rt_left, K_right,
+                                            Rt_right, depths)
+
+    if rectified:
+        """
+        On a rectified pair every plane is a horizontal shift.  Sweep the
+        integer shifts covering the depth range instead, with the left image
+        normalized only once.
+        """
+        shifts = rectified_translations(homographies, depths)
+        if shifts is None:
+            raise Exception('the stereo pair is not rectified')
+        translations, depths = shifts
+        with stage(timer, 'preprocess', height * width):
+            left_normalized = preprocess_ncc(left, ncc_size)
 
     """
-    Compute the NCC score between the right and left images.
+    We'll sweep a series of planes that are fronto-parallel to the right
+    camera.  The image from the left camera is to be projected onto each of
+    these planes, normalized, and then compared to the normalized right
+    image.
     """
-    ncc = compute_ncc(right_normalized, left_normalized)
+    if workers > 1:
+        volume = parallel_plane_sweep(left, right_normalized, homographies,
+                                      width, height, ncc_size, engine,
+                                      workers, timer, verbose)
+        if ncc_gif_writer is not None:
+            for pos in range(len(depths)):
+                ncc = volume[:, :, pos]
+                with stage(timer, 'gif', height * width):
+                    ncc_gif_writer.append(
+                        np.uint8(255 * np.clip(ncc / 2 + 0.5, 0, 1)))
+    else:
+        if streaming:
+            running = StreamingArgmax(height, width, second_best=confidence)
+        else:
+            volume = []
+        for pos in range(len(depths)):
+            if rectified:
+                projected_left, ncc = rectified_layer(
+                    left, left_normalized, right_normalized,
+                    translations[pos], engine, timer)
+            elif len(views) > 1:
+                projected_left, ncc = multi_sweep_layer(
+                    lefts, rights_normalized, homographies[pos], width,
+                    height, ncc_size, engine, aggregate, timer)
+            else:
+                projected_left, ncc = sweep_layer(
+                    left, right_normalized, homographies[pos], width, height,
+                    ncc_size, engine, timer)
+
+            if streaming:
+                running.update(pos, ncc)
+            else:
+                volume.append(ncc)
+
+            if projected_gif_writer is not None:
+                with stage(timer, 'gif', height * width):
+                    projected_gif_writer.append(np.uint8(projected_left))
+            if ncc_gif_writer is not None:
+                with stage(timer, 'gif', height * width):
+                    ncc_gif_writer.append(
+                        np.uint8(255 * np.clip(ncc / 2 + 0.5, 0, 1)))
+
+            if verbose:
+                sys.stdout.write(
+                    'Progress: {0}\r'.format(int(100 * pos / len(depths))))
+                sys.stdout.flush()
 
-    volume.append(ncc)
+    toc = time.time()
 
-    projected_gif_writer.append(np.uint8(projected_left))
-    ncc_gif_writer.append(np.uint8(255 * np.clip(ncc / 2 + 0.5, 0, 1)))
+    if verbose:
+        print ('Plane sweep took {0} seconds'.format(toc - tic))
+
+    if timer is not None:
+        timer.add('sweep', toc - tic, 1, height * width * len(depths))
+
+    margin = None
+    if streaming:
+        labels = running.label
+        if confidence:
+            margin = running.confidence()
+        volume = None
+    else:
+        """
+        All of these separate NCC layers get stacked together into a volume.
+        """
+        if workers == 1:
+            volume = np.dstack(volume)
+
+        """
+        We're going to use the simplest algorithm to select a depth layer
+        per pixel -- the argmax across depth labels.
+        """
+        labels = volume.argmax(axis=2)
+        if confidence:
+            top_two = np.partition(volume, -2, axis=2)[:, :, -2:]
+            margin = top_two[:, :, 1] - top_two[:, :, 0]
+        if not return_volume:
+            volume = None
+
+    """
+    Remap the label IDs back to their associated depth values.
+    """
+    return SweepResult(labels, depths[labels], depths, volume, margin)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset')
+    parser.add_argument('--ncc', choices=sorted(NCC_ENGINES), default='patch',
+                        help='NCC engine: explicit patch vectors or '
+                             'box-filtered sums')
+    parser.add_argument('--streaming', action='store_true',
+                        help='keep a running argmax instead of the full cost '
+                             'volume')
+    parser.add_argument('--confidence', action='store_true',
+                        help='also save the best minus second-best NCC '
+                             'margin')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to split the depth layers '
+                             'across')
+    parser.add_argument('--levels', type=int, default=1,
+                        help='pyramid levels for a coarse-to-fine sweep; 1 '
+                             'sweeps every depth at full resolution')
+    parser.add_argument('--band', type=int, default=4,
+                        help='labels tested on either side of the coarse '
+                             'winner at finer levels')
+    parser.add_argument('--rectified', action='store_true',
+                        help='sweep integer disparities by shifting the left '
+                             'image; requires a rectified pair')
+    parser.add_argument('--all-views', action='store_true',
+                        help='score every depth against all left/right pairs '
+                             'of the dataset, e.g. every Tentacle lighting')
+    parser.add_argument('--aggregate', choices=NCC_AGGREGATES, default='mean',
+                        help='how --all-views combines the per-view NCC: mean '
+                             'or mean without the best and worst view')
+    parser.add_argument('--downscale', type=int, default=None,
+                        help='pyrdown steps before the sweep, defaults to the '
+                             "dataset's stereo_downscale_factor")
+    parser.add_argument('--no-gif', dest='gif', action='store_false',
+                        help='skip the NCC and projection GIFs')
+    parser.add_argument('--gif-format',
+                        choices=('gif', 'apng', 'npz', 'convert'),
+                        default='gif',
+                        help='encode the GIFs in process as a gif, animated '
+                             'png or npz frame stack, or with ImageMagick '
+                             'convert')
+    parser.add_argument('--gif-every', type=int, default=1,
+                        help='keep one GIF frame out of every N depth layers')
+    parser.add_argument('--gif-scale', type=int, default=1,
+                        help='shrink GIF frames by this factor')
+    parser.add_argument('--profile', action='store_true',
+                        help='save per-stage timings to data.profile_json')
+    args = parser.parse_args()
+
+    data = load_dataset(args.dataset)
+    views = list(range(len(data.left))) if args.all_views else [0]
+
+    try:
+        check_sweep_options(args.streaming, args.confidence, args.workers,
+                            args.levels, args.rectified, False, len(views))
+    except Exception as exc:
+        parser.error(str(exc))
+
+    def open_gif(temp_format, dest_gif):
+        if args.gif_format == 'convert':
+            writer = GifWriter(temp_format, dest_gif)
+        else:
+            extension = {'gif': '.gif', 'apng': '.apng', 'npz': '.npz'}
+            dest = os.path.splitext(dest_gif)[0] + extension[args.gif_format]
+            writer = StreamingGifWriter(dest, args.gif_every, args.gif_scale)
+        return AsyncGifWriter(writer)
+
+    """
+    The per-layer GIFs are only diagnostics.  Frames are encoded on
+    background threads so the sweep does not wait on PNG encoding or the
+    disk.  The coarse-to-fine sweep has no full layers to show, and the pool
+    only has the NCC layers.
+    """
+    writers = []
+    ncc_gif_writer = None
+    projected_gif_writer = None
+    if args.gif and args.levels == 1:
+        ncc_gif_writer = open_gif(data.ncc_temp, data.ncc_gif)
+        writers.append(ncc_gif_writer)
+        if args.workers == 1:
+            projected_gif_writer = open_gif(data.projected_temp,
+                                            data.projected_gif)
+            writers.append(projected_gif_writer)
 
-    sys.stdout.write('Progress: {0}\r'.format(int(100 * pos / len(depths))))
-    sys.stdout.flush()
+    timer = StageTimer() if args.profile else None
 
-toc = time.time()
+    result = plane_sweep(
+        data, downscale=args.downscale, engine=args.ncc,
+        streaming=args.streaming, confidence=args.confidence,
+        workers=args.workers, levels=args.levels, band=args.band,
+        rectified=args.rectified, views=views, aggregate=args.aggregate,
+        ncc_gif_writer=ncc_gif_writer,
+        projected_gif_writer=projected_gif_writer, timer=timer, verbose=True)
 
-print ('Plane sweep took {0} seconds'.format(toc - tic))
+    for writer in writers:
+        with stage(timer, 'gif'):
+            writer.close()
 
-ncc_gif_writer.close()
-projected_gif_writer.close()
+    if timer is not None:
+        print ('Saving timings to {0}'.format(data.profile_json))
+        timer.save(data.profile_json)
 
-"""
-All of these separate NCC layers get stacked together into a volume.
-"""
-volume = np.dstack(volume)
+    print ('Saving NCC to {0}'.format(data.ncc_png))
+    imwrite(data.ncc_png, np.uint8(np.clip(result.labels * 2, 0, 255)))
 
-"""
-We're going to use the simplest algorithm to select a depth layer per pixel --
-the argmax across depth labels.
-"""
-solution = volume.argmax(axis=2)
+    print ('Saving depth to {0}'.format(data.depth_npy))
+    np.save(data.depth_npy, result.depth)
 
-print ('Saving NCC to {0}'.format(data.ncc_png))
-imwrite(data.ncc_png, solution * 2)
+    if args.confidence:
+        print ('Saving confidence to {0}'.format(data.confidence_npy))
+        np.save(data.confidence_npy, result.confidence)
 
-"""
-Remap the label IDs back to their associated depth values.
-"""
-solution = depths[solution]
 
-print ('Saving depth to {0}'.format(data.depth_npy))
-np.save(data.depth_npy, solution)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+import time
+from collections import namedtuple
+
+import numpy as np
+from scipy.fft import dctn, idctn
+from scipy.sparse import diags, coo_matrix, kron, issparse
+from scipy.sparse.linalg import lsqr, lsmr, cg, spsolve, splu, \
+    LinearOperator
+
+
+SolveResult = namedtuple('SolveResult',
+                         ['x', 'iterations', 'residual', 'seconds'])
+
+
+def _float64(A, b):
+    """
+    form_poisson_equation builds a float32 system.  The iterative solvers
+    keep their scalar estimates in the dtype of A, so solve in float64.
+    """
+    if A.dtype != np.float64:
+        A = A.astype(np.float64)
+    return A, np.asarray(b, dtype=np.float64)
+
+
+def _result(A, b, x, iterations, tic):
+    seconds = time.perf_counter() - tic
+    residual = np.linalg.norm(A.dot(x) - b)
+    return SolveResult(x, iterations, residual, seconds)
+
+
+def _normal_equations(A, b):
+    if not issparse(A):
+        raise Exception('this solver needs A as a sparse matrix, not a '
+                        'matrix-free operator')
+    AtA = A.T.dot(A).tocsr()
+    Atb = A.T.dot(b)
+    return AtA, Atb
+
+
+def _regularize(AtA):
+    """
+    Make the normal equations nonsingular.  With normals only, the depth is
+    defined only up to a constant offset per connected region, so a ridge
+    of 1e-10 times the largest diagonal entry is added; it pulls those free
+    offsets towards zero as lsqr does.  Unknowns that no row touches get a
+    unit diagonal and solve to zero.
+    """
+    diagonal = AtA.diagonal()
+    ridge = 1e-10 * diagonal.max() if len(diagonal) else 0
+    diagonal = np.where(diagonal == 0, 1, ridge)
+    return (AtA + diags(diagonal)).tocsr()
+
+
+def solve_lsqr(A, b, x0=None, tol=None, maxiter=None, shape=None):
+    """
+    scipy's lsqr.  tol sets both its atol and btol, which default to 1e-6.
+    """
+    tic = time.perf_counter()
+    A, b = _float64(A, b)
+    kwargs = {}
+    if tol is not None:
+        kwargs = {'atol': tol, 'btol': tol}
+    solution = lsqr(A, b, iter_lim=maxiter, x0=x0, **kwargs)
+    return _result(A, b, solution[0], solution[2], tic)
+
+
+def solve_lsmr(A, b, x0=None, tol=None, maxiter=None, shape=None):
+    """
+    scipy's lsmr, which solves the same least squares problem as lsqr but
+    usually stops earlier because its residual for A^T r decreases
+    monotonically.  tol sets both its atol and btol, which default to 1e-6.
+    """
+    tic = time.perf_counter()
+    A, b = _float64(A, b)
+    kwargs = {}
+    if tol is not None:
+        kwargs = {'atol': tol, 'btol': tol}
+    solution = lsmr(A, b, maxiter=maxiter, x0=x0, **kwargs)
+    return _result(A, b, solution[0], solution[2], tic)
+
+
+def solve_cg(A, b, x0=None, tol=None, maxiter=None, shape=None):
+    """
+    Conjugate gradients on the normal equations A^T A x = A^T b with a
+    Jacobi (diagonal) preconditioner.  tol is the relative tolerance on the
+    normal equations residual and defaults to 1e-8.  A may also be a
+    matrix-free operator such as util.PoissonOperator that provides
+    normal_diagonal().
+    """
+    tic = time.perf_counter()
+    A, b = _float64(A, b)
+    if issparse(A):
+        AtA, Atb = _normal_equations(A, b)
+        diagonal = AtA.diagonal()
+    else:
+        AtA = A.T.dot(A)
+        Atb = A.rmatvec(b)
+        diagonal = A.normal_diagonal()
+
+    # Unknowns that no row touches have a zero diagonal.  They stay at x0.
+    diagonal[diagonal == 0] = 1
+    preconditioner = diags(1.0 / diagonal)
+
+    iterations = [0]
+
+    def count(xk):
+        iterations[0] += 1
+
+    x, _ = cg(AtA, Atb, x0=x0, rtol=1e-8 if tol is None else tol,
+              maxiter=maxiter, M=preconditioner, callback=count)
+    return _result(A, b, x, iterations[0], tic)
+
+
+def solve_direct(A, b, x0=None, tol=None, maxiter=None, shape=None):
+    """
+    Sparse LU factorization of the normal equations A^T A x = A^T b, made
+    nonsingular as described in _regularize.  x0, tol and maxiter are
+    ignored.
+    """
+    tic = time.perf_counter()
+    A, b = _float64(A, b)
+    AtA, Atb = _normal_equations(A, b)
+    x = spsolve(_regularize(AtA).tocsc(), Atb)
+    return _result(A, b, x, 1, tic)
+
+
+def _pyrup_matrix(coarse, fine):
+    """
+    util.pyrup along one axis as a fine x coarse sparse matrix: zero
+    insertion followed by the 1/8 [1 4 6 4 1] kernel with a
+    BORDER_REFLECT_101 border, cropped to fine samples.
+    """
+    kernel = np.array([1.0, 4.0, 6.0, 4.0, 1.0]) / 8.0
+    length = 2 * coarse
+    rows, taps = np.meshgrid(np.arange(fine), np.arange(5), indexing='ij')
+    source = np.abs(rows + taps - 2)
+    source = np.where(source >= length, 2 * (length - 1) - source, source)
+
+    # Only the even samples of the zero-inserted signal are nonzero.
+    even = source % 2 == 0
+    return coo_matrix((kernel[taps[even]], (rows[even], source[even] // 2)),
+                      shape=(fine, coarse)).tocsr()
+
+
+def _jacobi_spectral_radius(N, inverse_diagonal, iterations):
+    """
+    Power iteration estimate of the largest eigenvalue of D^-1 N for a
+    symmetric positive definite N with inverse diagonal D^-1.  Its
+    eigenvalues are those of the symmetric D^-1/2 N D^-1/2, which is what
+    the iteration runs on.
+    """
+    scale = np.sqrt(inverse_diagonal)
+    x = np.random.RandomState(0).random_sample(N.shape[0])
+    estimate = 1.0
+    for i in range(iterations):
+        y = scale * N.dot(scale * x)
+        estimate = np.linalg.norm(y) / np.linalg.norm(x)
+        x = y / np.linalg.norm(y)
+    return estimate
+
+
+class _Multigrid(object):
+    """
+    Geometric multigrid hierarchy for a symmetric system N over the active
+    pixels of a height x width grid.  Prolongation is util.pyrup written as
+    a sparse matrix P, restricted to the active pixels, and restriction is
+    its transpose (util.pyrdown up to a factor of 4 and the border
+    handling).  Every coarse operator is the Galerkin product P^T N P, so
+    the alpha mask and the depth_weight terms carry over to the coarse
+    grids without rediscretizing.  Coarse pixels that do not reach any
+    active pixel are dropped.  The coarsest grid is solved directly and the
+    smoother is damped Jacobi.
+
+    The Galerkin operators get denser and their Jacobi spectrum wider with
+    every level, so one fixed damping makes the smoother diverge on the
+    coarse grids.  Each level instead uses omega = 4 / (3 lambda) with
+    lambda an estimate of the largest eigenvalue of D^-1 N from
+    power_iterations steps, which keeps omega lambda well below 2.
+    """
+
+    def __init__(self, N, active, coarsest=1024, smoothing=2,
+                 power_iterations=10):
+        self.smoothing = smoothing
+        self.operators = [N]
+        self.prolongations = []
+        self.restrictions = []
+
+        height, width = active.shape
+        while N.shape[0] > coarsest and min(height, width) > 2:
+            coarse_height = (height + 1) // 2
+            coarse_width = (width + 1) // 2
+            P = kron(_pyrup_matrix(coarse_height, height),
+                     _pyrup_matrix(coarse_width, width), format='csr')
+            if not active.all():
+                P = P[active.ravel()]
+                active = (P.getnnz(axis=0) > 0).reshape(coarse_height,
+                                                        coarse_width)
+                P = P[:, active.ravel()]
+            else:
+                active = np.ones((coarse_height, coarse_width), dtype=bool)
+
+            R = P.T.tocsr()
+            N = R.dot(N.dot(P)).tocsr()
+            self.prolongations.append(P)
+            self.restrictions.append(R)
+            self.operators.append(N)
+            height, width = coarse_height, coarse_width
+
+        self.inverse_diagonals = [1.0 / N.diagonal()
+                                  for N in self.operators[:-1]]
+        self.omegas = [
+            4.0 / (3.0 * _jacobi_spectral_radius(N, inverse_diagonal,
+                                                 power_iterations))
+            for N, inverse_diagonal in zip(self.operators,
+                                           self.inverse_diagonals)]
+        self.coarse_solver = splu(self.operators[-1].tocsc())
+
+    def _smooth(self, level, x, f):
+        N = self.operators[level]
+        weights = self.omegas[level] * self.inverse_diagonals[level]
+        for i in range(self.smoothing):
+            x += weights * (f - N.dot(x))
+        return x
+
+    def v_cycle(self, f, level=0):
+        if level == len(self.prolongations):
+            return self.coarse_solver.solve(f)
+
+        x = self._smooth(level, np.zeros_like(f), f)
+        residual = f - self.operators[level].dot(x)
+        coarse = self.v_cycle(self.restrictions[level].dot(residual),
+                              level + 1)
+        x += self.prolongations[level].dot(coarse)
+        return self._smooth(level, x, f)
+
+
+def solve_multigrid(A, b, x0=None, tol=None, maxiter=None, shape=None):
+    """
+    Conjugate gradients on the normal equations, made nonsingular as
+    described in _regularize, preconditioned with one multigrid V-cycle
+    (see _Multigrid) per iteration.  The number of iterations is nearly
+    independent of the grid size.  Only the pixels that appear in some row
+    of A are solved for; the others are zero.  tol is the relative
+    tolerance on the normal equations residual and defaults to 1e-8.
+    shape is the (height, width) of the grid and is required.
+    """
+    if shape is None:
+        raise Exception('the multigrid solver needs the grid shape')
+
+    tic = time.perf_counter()
+    A, b = _float64(A, b)
+    AtA, Atb = _normal_equations(A, b)
+
+    active = AtA.diagonal() > 0
+    if not active.any():
+        return _result(A, b, np.zeros(A.shape[1]), 0, tic)
+    if not active.all():
+        AtA = AtA[active][:, active]
+    N = _regularize(AtA)
+    hierarchy = _Multigrid(N, active.reshape(shape))
+    preconditioner = LinearOperator(N.shape, matvec=hierarchy.v_cycle,
+                                    dtype=np.float64)
+
+    iterations = [0]
+
+    def count(xk):
+        iterations[0] += 1
+
+    if x0 is not None:
+        x0 = np.asarray(x0, dtype=np.float64)[active]
+    solution, _ = cg(N, Atb[active], x0=x0,
+                     rtol=1e-8 if tol is None else tol, maxiter=maxiter,
+                     M=preconditioner, callback=count)
+
+    x = np.zeros(A.shape[1])
+    x[active] = solution
+    return _result(A, b, x, iterations[0], tic)
+
+
+def _normals_residual(normals, depth):
+    """
+    |A x - b| for the system form_poisson_equation builds from normals
+    alone with a full alpha mask, evaluated without building it.
+    """
+    nz = -normals[:, :, 2]
+    dx = nz[:, :-1] * (depth[:, 1:] - depth[:, :-1]) + normals[:, :-1, 0]
+    dy = nz[:-1] * (depth[1:] - depth[:-1]) - normals[:-1, :, 1]
+    return np.sqrt(np.square(dx).sum() + np.square(dy).sum())
+
+
+def integrate_normals_dct(normals):
+    """
+    Integrate a height x width x 3 normal map over the full image rectangle
+    in O(N log N), in the style of Frankot and Chellappa.
+
+    The normals give target depth differences -nx / nz to the right and
+    ny / nz downwards, with the sign conventions of form_poisson_equation.
+    The least squares depth for those differences solves a Poisson
+    equation with Neumann boundaries, which the type II DCT diagonalizes.
+    Pixels with nz near zero, e.g. zero normals in the background, get a
+    zero slope.  The depth is returned with zero mean.
+
+    Unlike the sparse system, every difference is weighted equally rather
+    than by nz, so the two agree exactly when nz is constant.  The reported
+    residual is that of the sparse system, for comparison with SOLVERS.
+
+    Output:
+        SolveResult with the flattened height x width depth
+    """
+    tic = time.perf_counter()
+    normals = np.asarray(normals, dtype=np.float64)
+    height, width, _ = normals.shape
+
+    nz = -normals[:, :, 2]
+    flat = np.abs(nz) < 1e-6
+    nz = np.where(flat, 1, nz)
+    slope_x = np.where(flat, 0, -normals[:, :, 0] / nz)[:, :-1]
+    slope_y = np.where(flat, 0, normals[:, :, 1] / nz)[:-1]
+
+    # Divergence D^T g of the target differences.
+    divergence = np.zeros((height, width))
+    divergence[:, :-1] -= slope_x
+    divergence[:, 1:] += slope_x
+    divergence[:-1] -= slope_y
+    divergence[1:] += slope_y
+
+    rows = np.square(2 * np.sin(np.pi * np.arange(height) / (2 * height)))
+    cols = np.square(2 * np.sin(np.pi * np.arange(width) / (2 * width)))
+    eigenvalues = rows[:, np.newaxis] + cols[np.newaxis]
+    eigenvalues[0, 0] = 1
+
+    spectrum = dctn(divergence, type=2, norm='ortho') / eigenvalues
+    spectrum[0, 0] = 0
+    depth = idctn(spectrum, type=2, norm='ortho')
+
+    seconds = time.perf_counter() - tic
+    return SolveResult(depth.ravel(), 1, _normals_residual(normals, depth),
+                       seconds)
+
+
+# Least squares solvers for sparse systems such as the one from
+# util.form_poisson_equation.  Each takes (A, b, x0=None, tol=None,
+# maxiter=None, shape=None), where shape is the (height, width) of the grid
+# of unknowns for the solvers that need it, and returns a SolveResult with
+# the solution, the number of iterations, the residual norm |A x - b| and
+# the time taken in seconds.
+SOLVERS = {
+    'lsqr': solve_lsqr,
+    'lsmr': solve_lsmr,
+    'cg': solve_cg,
+    'direct': solve_direct,
+    'multigrid': solve_multigrid,
+}
+
+# The solvers that also accept the matrix-free operator from
+# util.form_poisson_operator in place of A.
+MATRIX_FREE = ('lsqr', 'lsmr', 'cg')
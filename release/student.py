@@ -30,37 +30,38 @@ def compute_photometric_stereo_impl(lights, images):
         normals -- float32 height x width x 3 image with dimensions matching
                    the input images.
     """
-    img_shape = images[0].shape
+    height, width, channels = images[0].shape
     n = len(images)
-
-    I = np.zeros((img_shape[0], img_shape[1], n))
-    I = np.dstack([images[i][:, :, 0] for i in range(n)])
-
-    G = np.matmul(np.matmul(I, np.transpose(lights)), np.linalg.inv(
-        np.matmul(lights, np.transpose(lights))))
-
-    kd = np.linalg.norm(G, axis=2)
-    kd = np.where(kd == 0, 1e-7, kd)
-    normals = G / kd[:, :, np.newaxis]
-    normals[kd == 0] = 0
-
-    num = np.zeros(img_shape)
-    den = np.zeros(img_shape)
-
-    for j in range(n):
-        currChannel = images[j]
-
-        num += np.dot(normals, lights[:, j])[..., np.newaxis] * currChannel
-        den += np.square(np.dot(normals, lights[:, j]))[..., np.newaxis]
-
-    den[den == 0] = 1
-    albedo = np.divide(num, den, where=den > 0)
-
-    mask = np.linalg.norm(albedo, axis=2) < 1e-7
+    pixels = height * width
+
+    # N x P x C observations, one contiguous block per image.
+    I = np.stack(images).astype(np.float32, copy=False).reshape(
+        n, pixels, channels)
+
+    # G = (L L^T)^-1 L I for every pixel and channel in one GEMM, then
+    # summed over channels so that all of them constrain the normal.
+    lights = np.asarray(lights, dtype=np.float64)
+    pinv = np.float32(np.linalg.solve(lights.dot(lights.T), lights))
+    G = pinv.dot(I.reshape(n, pixels * channels))
+    G = G.reshape(3 * pixels, channels).dot(
+        np.ones(channels, dtype=np.float32)).reshape(3, pixels)
+
+    kd = np.sqrt(np.einsum('kp,kp->p', G, G))
+    normals = G / np.where(kd == 0, 1, kd)
+
+    # Per-channel least squares albedo against the N x P shading n . l_j.
+    shading = np.float32(lights).T.dot(normals)
+    num = np.einsum('jp,jpc->pc', shading, I)
+    den = np.einsum('jp,jp->p', shading, shading)
+    albedo = num / np.where(den == 0, 1, den)[:, np.newaxis]
+
+    normals = normals.T
+    mask = np.linalg.norm(albedo, axis=1) < 1e-7
     albedo[mask] = 0
     normals[mask] = 0
 
-    return albedo.astype(np.float32), normals.astype(np.float32)
+    return (albedo.reshape(height, width, channels),
+            np.ascontiguousarray(normals).reshape(height, width, 3))
 
 
 def pyrdown_impl(image):
@@ -159,22 +160,41 @@ def project_impl(K, Rt, points):
     Project 3D points into a calibrated camera.
 
     Input:
-        K -- camera intrinsics calibration matrix
-        Rt -- 3 x 4 camera extrinsics calibration matrix
-        points -- height x width x 3 array of 3D points
+        K -- camera intrinsics calibration matrix, or a stack of C of them
+        Rt -- 3 x 4 camera extrinsics calibration matrix, or a stack of C
+        points -- ... x 3 array of 3D points with any leading shape, e.g.
+                  height x width x 3
     Output:
-        projections -- height x width x 2 array of 2D projections
+        projections -- ... x 2 array of 2D projections, or C x ... x 2 with
+                       a stack of cameras.  Points behind a camera project
+                       to (0, 0).
     """
-    height, width, _ = np.shape(points)
-    proj = np.zeros((height, width, 2))
-
-    for i in range(height):
-        for j in range(width):
-            location = np.matmul(K, np.matmul(Rt, np.append(points[i, j], 1)))
-
-            if location[2] >= 1e-7:
-                proj[i, j] = location[:2] / location[2]
-
+    K = np.asarray(K)
+    Rt = np.asarray(Rt)
+    stacked = K.ndim == 3 or Rt.ndim == 3
+    K = K.reshape(-1, 3, 3)
+    Rt = Rt.reshape(-1, 3, 4)
+    count = max(len(K), len(Rt))
+    K = np.broadcast_to(K, (count, 3, 3))
+    Rt = np.broadcast_to(Rt, (count, 3, 4))
+
+    points = np.asarray(points)
+    batch = points.shape[:-1]
+    flat = points.reshape(-1, 3)
+
+    # C x N x 3 points in camera coordinates, then in homogeneous pixels.
+    camera = np.einsum('cij,nj->cni', Rt[:, :, :3], flat) + \
+        Rt[:, np.newaxis, :, 3]
+    location = np.einsum('cij,cnj->cni', K, camera)
+
+    proj = np.zeros(location.shape[:2] + (2,))
+    visible = location[:, :, 2] >= 1e-7
+    visible_location = location[visible]
+    proj[visible] = visible_location[:, :2] / visible_location[:, 2:]
+
+    proj = proj.reshape((len(proj),) + batch + (2,))
+    if not stacked:
+        proj = proj[0]
     return proj
 
 
@@ -293,37 +313,30 @@ def preprocess_ncc_impl(image, ncc_size):
         image -- height x width x channels image of type float32
         ncc_size -- integer width and height of NCC patch region.
     Output:
-        normalized -- heigth x width x (channels * ncc_size**2) array
+        normalized -- heigth x width x (channels * ncc_size**2) array of
+                      type float32
     """
-    img_shape = image.shape
-    ans = np.zeros([img_shape[0], img_shape[1],
-                   img_shape[2] * ncc_size * ncc_size])
-    low = - (ncc_size // 2)
-    high = ncc_size // 2
-
-    for y in range(img_shape[0]):
-        for x in range(img_shape[1]):
-            condition = (
-                y + low >= 0 and
-                x + low >= 0 and
-                y + high < img_shape[0] and
-                x + high < img_shape[1]
-            )
-
-            if condition:
-                for k in range(img_shape[2]):
-                    patch = image[y + low: y + high +
-                                  1, x + low: x + high + 1, k]
-                    flat_patch = patch.reshape(-1)
-                    start = k * ncc_size * ncc_size
-                    end = (k + 1) * ncc_size * ncc_size
-                    ans[y, x, start:end] = np.asarray(flat_patch)
-
-    ans -= np.mean(ans, axis=2)[:, :, np.newaxis]
-
-    norm = np.linalg.norm(ans, axis=2)[:, :, np.newaxis]
-    norm[norm == 0] = 1
-    ans /= norm
+    height, width, channels = image.shape
+    half = ncc_size // 2
+
+    # Patches are laid out as channels x ncc_size x ncc_size so the trailing
+    # axes flatten in the required channel-major order as a view.
+    ans = np.zeros((height, width, channels, ncc_size, ncc_size),
+                   dtype=np.float32)
+    if height < ncc_size or width < ncc_size:
+        return ans.reshape(height, width, -1)
+
+    windows = np.lib.stride_tricks.sliding_window_view(
+        image, (ncc_size, ncc_size), axis=(0, 1))
+    inner = ans[half:height - half, half:width - half]
+    inner[...] = windows
+
+    inner -= inner.mean(axis=(3, 4), keepdims=True)
+
+    ans = ans.reshape(height, width, -1)
+    norm = np.sqrt(np.einsum('ijk,ijk->ij', ans, ans))
+    norm[norm < 1e-6] = np.inf
+    ans /= norm[:, :, np.newaxis]
 
     return ans
 
@@ -1,10 +1,31 @@
 import numpy as np
 import math
-
-from imageio import imread
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import types
+import cv2
+
+from imageio import imread, mimread
+
+from timing import StageTimer
+from camera import Camera
+from solvers import SOLVERS, MATRIX_FREE, integrate_normals_dct
+from hierarchical_sweep import hierarchical_plane_sweep, _upsample_labels
+from parallel_sweep import parallel_plane_sweep
+from plane_sweep_stereo import plane_sweep
+from gifwriter import AsyncGifWriter, StreamingGifWriter
 
 from util import preprocess_ncc, compute_ncc, project, unproject_corners, \
-    pyrdown, pyrup, compute_photometric_stereo
+    pyrdown, pyrup, compute_photometric_stereo, preprocess_ncc_box, \
+    compute_ncc_box, StreamingArgmax, compute_homographies, sweep_layer, \
+    rectified_translations, rectified_layer, multi_sweep_layer, aggregate_ncc, \
+    form_poisson_equation, form_poisson_operator, save_mesh, build_mesh, \
+    photometric_stereo_rows, rerendering_error, \
+    compute_robust_photometric_stereo, NCC_ENGINES
 
 def skip_not_implemented(func):
     from nose.plugins.skip import SkipTest
@@ -80,6 +101,112 @@ def offset_and_scale_ncc_test():
         np.abs(ncc[ncc_half:-ncc_half, ncc_half:-ncc_half] - 1) < 1e-6).all()
 
 
+@skip_not_implemented
+def ncc_per_channel_offset_test():
+    ncc_size = 5
+    ncc_half = ncc_size // 2
+
+    # The mean is removed per channel, so a different offset in every
+    # channel still correlates perfectly.  A joint mean would not.
+    image1 = np.random.random((3 * ncc_size, 2 * ncc_size - 1, 3))
+    image2 = image1 * 2 + np.array((3, -5, 7))
+
+    n1 = preprocess_ncc(image1, ncc_size)
+    ncc = compute_ncc(n1, preprocess_ncc(image2, ncc_size))
+    assert (
+        np.abs(ncc[ncc_half:-ncc_half, ncc_half:-ncc_half] - 1) < 1e-6).all()
+
+    # The norm is still joint over all channels.
+    patch = image1[:ncc_size, :ncc_size].transpose(2, 0, 1).reshape(3, -1)
+    patch = patch - patch.mean(axis=1, keepdims=True)
+    expected = patch.ravel() / np.linalg.norm(patch)
+    assert np.allclose(n1[ncc_half, ncc_half], expected, atol=1e-6)
+
+    # The box engine agrees on unrelated color images too.
+    image3 = np.random.random(image1.shape)
+    expected = compute_ncc(n1, preprocess_ncc(image3, ncc_size))
+    ncc_box = compute_ncc_box(preprocess_ncc_box(image1, ncc_size),
+                              preprocess_ncc_box(image3, ncc_size))
+    assert np.allclose(ncc_box, expected, atol=1e-5)
+
+
+@skip_not_implemented
+def box_ncc_per_channel_offset_test():
+    ncc_size = 5
+    ncc_half = ncc_size // 2
+
+    image1 = np.random.random((3 * ncc_size, 2 * ncc_size - 1, 3))
+    image2 = image1 * 2 + np.array((3, -5, 7))
+
+    ncc = compute_ncc_box(preprocess_ncc_box(image1, ncc_size),
+                          preprocess_ncc_box(image2, ncc_size))
+
+    assert ncc.shape == (3 * ncc_size, 2 * ncc_size - 1)
+    assert (np.abs(ncc[:ncc_half, :]) < 1e-6).all()
+    assert (np.abs(ncc[-ncc_half:, :]) < 1e-6).all()
+    assert (np.abs(ncc[:, :ncc_half]) < 1e-6).all()
+    assert (np.abs(ncc[:, -ncc_half:]) < 1e-6).all()
+    assert (
+        np.abs(ncc[ncc_half:-ncc_half, ncc_half:-ncc_half] - 1) < 1e-6).all()
+
+
+@skip_not_implemented
+def box_ncc_matches_patch_ncc_test():
+    ncc_size = 5
+
+    image1 = np.random.random((4 * ncc_size, 3 * ncc_size, 1))
+    image2 = np.random.random((4 * ncc_size, 3 * ncc_size, 1))
+    image2[:ncc_size, :ncc_size] = 0.5
+
+    expected = compute_ncc(preprocess_ncc(image1, ncc_size),
+                           preprocess_ncc(image2, ncc_size))
+    ncc = compute_ncc_box(preprocess_ncc_box(image1, ncc_size),
+                          preprocess_ncc_box(image2, ncc_size))
+
+    assert (np.abs(ncc - expected) < 1e-6).all()
+
+
+@skip_not_implemented
+def box_ncc_matches_patch_ncc_dark_test():
+    ncc_size = 5
+
+    # 0-255 color images whose left half is nearly black with faint
+    # texture, like the Tentacle background.  Those patches have a tiny but
+    # real norm that must not be mistaken for rounding noise.
+    image1 = np.float32(255 * np.random.random((6 * ncc_size, 6 * ncc_size,
+                                                3)))
+    image2 = np.float32(255 * np.random.random(image1.shape))
+    image1[:, :3 * ncc_size] = np.float32(
+        0.002 * np.random.random((6 * ncc_size, 3 * ncc_size, 3)))
+    image2[:, :3 * ncc_size] = image1[:, :3 * ncc_size] * 2 + 0.001
+    image2[:ncc_size, :ncc_size] = 0
+
+    expected = compute_ncc(preprocess_ncc(image1, ncc_size),
+                           preprocess_ncc(image2, ncc_size))
+    ncc = compute_ncc_box(preprocess_ncc_box(image1, ncc_size),
+                          preprocess_ncc_box(image2, ncc_size))
+
+    half = ncc_size // 2
+    assert np.allclose(ncc[2 * ncc_size:-half, half:2 * ncc_size], 1,
+                       atol=1e-4)
+    assert (np.abs(ncc - expected) < 1e-4).all()
+
+
+@skip_not_implemented
+def streaming_argmax_matches_volume_test():
+    volume = np.random.randint(0, 4, (6, 7, 10)).astype(np.float32)
+
+    running = StreamingArgmax(6, 7, second_best=True)
+    for label in range(volume.shape[2]):
+        running.update(label, volume[:, :, label])
+
+    top_two = np.sort(volume, axis=2)[:, :, -2:]
+
+    assert (running.label == volume.argmax(axis=2)).all()
+    assert (running.best == volume.max(axis=2)).all()
+    assert (running.confidence() == top_two[:, :, 1] - top_two[:, :, 0]).all()
+
+
 @skip_not_implemented
 def project_Rt_identity_centered_test():
     width = 1
@@ -172,6 +299,700 @@ def project_unproject_Rt_identity_test():
     assert np.abs(projection[1, 1, 0] - width) < 1e-5
     assert np.abs(projection[1, 1, 1] - height) < 1e-5
 
+@skip_not_implemented
+def project_batch_and_camera_stack_test():
+    K = np.array(((100.0, 0, 32), (0, 100.0, 24), (0, 0, 1)))
+    Rt_left = np.zeros((3, 4))
+    Rt_left[:, :3] = np.identity(3)
+    Rt_right = Rt_left.copy()
+    Rt_right[0, 3] = -0.5
+
+    points = np.random.random((4, 2, 2, 3)) - 0.5
+    points[..., 2] += 2
+    # One point behind both cameras.
+    points[0, 0, 0, 2] = -1
+
+    projection = project(np.stack((K, K)), np.stack((Rt_left, Rt_right)),
+                         points)
+    assert projection.shape == (2, 4, 2, 2, 2)
+    assert (projection[:, 0, 0, 0] == 0).all()
+
+    for camera, Rt in enumerate((Rt_left, Rt_right)):
+        single = project(K, Rt, points)
+        assert single.shape == (4, 2, 2, 2)
+        assert np.allclose(projection[camera], single)
+        for i in range(len(points)):
+            assert np.allclose(single[i], project(K, Rt, points[i]))
+
+    camera = np.einsum('ij,...j->...i', Rt_right[:, :3], points) + \
+        Rt_right[:, 3]
+    expected = camera[..., :2] / camera[..., 2:] * 100 + (32, 24)
+    visible = camera[..., 2] > 0
+    assert np.allclose(projection[1][visible], expected[visible])
+
+@skip_not_implemented
+def camera_matches_project_unproject_test():
+    K = np.array(((120.0, 0, 31.5), (0, 118.0, 24.0), (0, 0, 1)))
+    angle = 0.1
+    Rt = np.zeros((3, 4))
+    Rt[:, :3] = ((math.cos(angle), 0, math.sin(angle)), (0, 1, 0),
+                 (-math.sin(angle), 0, math.cos(angle)))
+    Rt[:, 3] = (0.2, -0.1, 0.5)
+    camera = Camera(K, Rt)
+
+    for depth in (1.0, 3.5):
+        points = unproject_corners(K, 64, 48, depth, Rt)
+        assert np.allclose(unproject_corners(camera, 64, 48, depth), points)
+        assert np.allclose(project(camera, points), project(K, Rt, points))
+
+    # A whole sweep of corner sets at once.
+    depths = np.array((1.0, 2.0, 4.0))
+    corners = camera.unproject_corners(64, 48, depths)
+    assert corners.shape == (3, 2, 2, 3)
+    assert np.allclose(corners[2], unproject_corners(K, 64, 48, 4.0, Rt))
+    assert np.allclose(camera.center, camera.unproject((10.0, 20.0), 0))
+
+    half = camera.scaled(1)
+    assert camera.scaled(1) is half
+    assert camera.scaled(0) is camera
+    assert np.allclose(half.K[:2], K[:2] / 2)
+    # The original intrinsics are untouched.
+    assert np.allclose(camera.K, K)
+
+    try:
+        camera.K[0, 0] = 1
+        assert False
+    except ValueError:
+        pass
+    try:
+        camera.K = K
+        assert False
+    except AttributeError:
+        pass
+
+
+@skip_not_implemented
+def compute_homographies_matches_corners_test():
+    width = 40
+    height = 30
+
+    K_left = np.array(((50, 0, 21), (0, 55, 14), (0, 0, 1)), dtype=np.float64)
+    K_right = np.array(((48, 0, 19), (0, 52, 16), (0, 0, 1)),
+                       dtype=np.float64)
+
+    angle = 0.1
+    Rt_left = np.zeros((3, 4))
+    Rt_left[:, :3] = ((math.cos(angle), 0, math.sin(angle)),
+                      (0, 1, 0),
+                      (-math.sin(angle), 0, math.cos(angle)))
+    Rt_left[:, 3] = (-1, 0.2, 0.5)
+    Rt_right = np.zeros((3, 4))
+    Rt_right[:, :3] = np.identity(3)
+    Rt_right[:, 3] = (0.5, 0, 0)
+
+    depths = np.array((3, 5, 11), dtype=np.float32)
+    homographies = compute_homographies(K_left, Rt_left, K_right, Rt_right,
+                                        depths)
+
+    assert homographies.shape == (3, 3, 3)
+
+    for depth, H in zip(depths, homographies):
+        points = unproject_corners(K_right, width, height, depth, Rt_right)
+        points_left = np.float32(project(K_left, Rt_left, points))
+        points_right = np.float32(project(K_right, Rt_right, points))
+        expected, _ = cv2.findHomography(points_left.reshape(-1, 2),
+                                         points_right.reshape(-1, 2))
+
+        assert np.allclose(H, expected, atol=1e-3)
+
+
+@skip_not_implemented
+def rectified_translations_test():
+    K_left = np.array(((100, 0, 30), (0, 100, 20), (0, 0, 1)),
+                      dtype=np.float64)
+    K_right = np.array(((100, 0, 25), (0, 100, 20), (0, 0, 1)),
+                       dtype=np.float64)
+    Rt_left = np.zeros((3, 4), dtype=np.float32)
+    Rt_left[:, :3] = np.identity(3)
+    Rt_right = np.zeros((3, 4), dtype=np.float32)
+    Rt_right[:, :3] = np.identity(3)
+    Rt_right[0, 3] = 0.5
+
+    depths = np.array((10, 5, 2), dtype=np.float32)
+    homographies = compute_homographies(K_left, Rt_left, K_right, Rt_right,
+                                        depths)
+    translations, shift_depths = rectified_translations(homographies, depths)
+
+    # The left camera is offset by the baseline and its principal point by
+    # 5 pixels, so a plane at depth d shifts by 100 * 0.5 / d - 5 pixels.
+    assert (translations == np.arange(0, 21)).all()
+    assert np.allclose(100 * 0.5 / shift_depths - 5, translations)
+
+    Rt_left[:, :3] = ((1, 0, 0), (0, 0.8, -0.6), (0, 0.6, 0.8))
+    homographies = compute_homographies(K_left, Rt_left, K_right, Rt_right,
+                                        depths)
+    assert rectified_translations(homographies, depths) is None
+
+
+@skip_not_implemented
+def rectified_layer_matches_sweep_layer_test():
+    ncc_size = 5
+    ncc_half = ncc_size // 2
+    height = 12
+    width = 30
+    translation = -4
+
+    left = np.float32(np.random.random((height, width, 3)))
+    right = np.float32(np.random.random((height, width, 3)))
+    H = np.identity(3)
+    H[0, 2] = translation
+
+    for preprocess, compute, engine in (
+            (preprocess_ncc, compute_ncc, 'patch'),
+            (preprocess_ncc_box, compute_ncc_box, 'box')):
+        right_normalized = preprocess(right, ncc_size)
+        _, expected = sweep_layer(left, right_normalized, H, width, height,
+                                  ncc_size, engine)
+        _, ncc = rectified_layer(left, preprocess(left, ncc_size),
+                                 right_normalized, translation, engine)
+
+        # Away from the edge of the warp both paths see the same patches.
+        interior = slice(0, width + translation - ncc_half)
+        assert (np.abs(ncc[:, interior] - expected[:, interior]) < 1e-5).all()
+        assert (ncc[:, width + translation - ncc_half:] == 0).all()
+
+
+@skip_not_implemented
+def multi_sweep_layer_test():
+    ncc_size = 5
+    height = 20
+    width = 24
+
+    H = np.array([[1.02, 0.03, -1.5], [0.01, 0.98, 0.7], [1e-4, -2e-4, 1.0]])
+    lefts = [np.float32(np.random.random((height, width, 3)))
+             for i in range(3)]
+    rights = [np.float32(np.random.random((height, width, 3)))
+              for i in range(3)]
+    rights_normalized = [preprocess_ncc(right, ncc_size) for right in rights]
+
+    scores = []
+    for left, right_normalized in zip(lefts, rights_normalized):
+        _, ncc = sweep_layer(left, right_normalized, H, width, height,
+                             ncc_size)
+        scores.append(ncc)
+    scores = np.array(scores)
+
+    _, ncc = multi_sweep_layer(lefts, rights_normalized, H, width, height,
+                               ncc_size)
+    assert np.allclose(ncc, scores.mean(axis=0), atol=1e-4)
+
+    _, ncc = multi_sweep_layer(lefts, rights_normalized, H, width, height,
+                               ncc_size, aggregate='trimmed')
+    assert np.allclose(ncc, np.median(scores, axis=0), atol=1e-4)
+
+
+@skip_not_implemented
+def parallel_plane_sweep_matches_serial_test():
+    ncc_size = 5
+    height = 20
+    width = 24
+    left = np.float32(np.random.random((height, width, 3)))
+    right = np.float32(np.random.random((height, width, 3)))
+    homographies = [np.array([[1.0 + 0.01 * i, 0.02, -0.5 * i],
+                              [0.01, 0.99, 0.3],
+                              [1e-4, -2e-4, 1.0]]) for i in range(7)]
+
+    # The box engine normalizes into a namedtuple of arrays, which is shared
+    # with the workers field by field.
+    for engine in ('patch', 'box'):
+        preprocess, _ = NCC_ENGINES[engine]
+        right_normalized = preprocess(right, ncc_size)
+        expected = np.stack([sweep_layer(left, right_normalized, H, width,
+                                         height, ncc_size, engine)[1]
+                             for H in homographies], axis=2)
+
+        volume = parallel_plane_sweep(left, right_normalized, homographies,
+                                      width, height, ncc_size, engine,
+                                      workers=2)
+        # Single threaded OpenCV in the workers may round the box sums
+        # differently.
+        assert volume.shape == (height, width, len(homographies))
+        assert np.allclose(volume, expected, atol=1e-6)
+
+
+@skip_not_implemented
+def plane_sweep_leaves_dataset_unchanged_test():
+    height = 40
+    width = 48
+    K = np.array(((80.0, 0, 24), (0, 80.0, 20), (0, 0, 1)))
+    Rt_left = np.hstack((np.identity(3), [[0.5], [0], [0]]))
+    Rt_right = np.hstack((np.identity(3), np.zeros((3, 1))))
+    image = np.float32(cv2.resize(np.random.random((height // 4, width // 4,
+                                                    3)), (width, height)))
+    data = types.SimpleNamespace(
+        left=[image], right=[np.float32(np.roll(image, 3, axis=1))],
+        K_left=K.copy(), Rt_left=Rt_left, K_right=K.copy(), Rt_right=Rt_right,
+        ncc_size=5, stereo_downscale_factor=1, min_depth=4.0, max_depth=12.0,
+        depth_layers=8)
+    left = data.left[0].copy()
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = plane_sweep(data)
+        streamed = plane_sweep(data, streaming=True)
+
+    assert output.getvalue() == ''
+    assert (data.K_left == K).all() and (data.K_right == K).all()
+    assert (data.left[0] == left).all()
+    assert result.labels.shape == (height // 2, width // 2)
+    assert (streamed.labels == result.labels).all()
+    assert (streamed.depth == result.depth).all()
+
+
+class _RecordingWriter(object):
+    """
+    Frame writer stand-in for the GifWriter tests.  It is slow enough for
+    frames to queue up, and raises on the frame equal to fail.
+    """
+
+    def __init__(self, fail=None):
+        self.frames = []
+        self.fail = fail
+        self.closed = False
+
+    def append(self, image):
+        time.sleep(0.002)
+        if self.fail is not None and image == self.fail:
+            raise ValueError('cannot encode frame {0}'.format(image))
+        self.frames.append(image)
+
+    def close(self):
+        self.closed = True
+
+
+@skip_not_implemented
+def async_gif_writer_flushes_on_close_test():
+    writer = _RecordingWriter()
+    async_writer = AsyncGifWriter(writer, max_pending=2)
+    for i in range(10):
+        async_writer.append(i)
+    async_writer.close()
+
+    assert writer.frames == list(range(10))
+    assert writer.closed
+
+
+@skip_not_implemented
+def async_gif_writer_reraises_test():
+    # The failure surfaces on a later append once the thread has seen it.
+    async_writer = AsyncGifWriter(_RecordingWriter(fail=0))
+    raised = False
+    for i in range(1000):
+        try:
+            async_writer.append(i)
+        except ValueError:
+            raised = True
+            break
+        time.sleep(0.001)
+    assert raised
+
+    async_writer = AsyncGifWriter(_RecordingWriter(fail=1))
+    for i in range(3):
+        async_writer.append(i)
+    try:
+        async_writer.close()
+        assert False
+    except ValueError:
+        pass
+
+
+@skip_not_implemented
+def streaming_gif_writer_test():
+    frames = [np.uint8(np.random.randint(0, 256, size=(12, 16, 3)))
+              for i in range(10)]
+
+    directory = tempfile.mkdtemp()
+    try:
+        # Frames 0, 3, 6 and 9 are kept, at half size.
+        npz = os.path.join(directory, 'frames.npz')
+        writer = StreamingGifWriter(npz, every=3, scale=2)
+        for frame in frames:
+            writer.append(frame)
+        writer.close()
+        stack = np.load(npz)['frames']
+
+        gif = os.path.join(directory, 'frames.gif')
+        writer = StreamingGifWriter(gif, every=3)
+        for frame in frames:
+            writer.append(frame)
+        writer.close()
+        decoded = mimread(gif)
+    finally:
+        shutil.rmtree(directory)
+
+    assert stack.shape == (4, 6, 8, 3) and stack.dtype == np.uint8
+    assert (stack[1] == cv2.resize(frames[3], (8, 6),
+                                   interpolation=cv2.INTER_AREA)).all()
+    assert len(decoded) == 4
+    assert all(frame.shape[:2] == (12, 16) for frame in decoded)
+
+
+@skip_not_implemented
+def hierarchical_full_band_matches_dense_test():
+    ncc_size = 5
+    height = 32
+    width = 40
+    K = np.array(((40.0, 0, 20), (0, 40.0, 16), (0, 0, 1)))
+    Rt_left = np.hstack((np.identity(3), [[0.5], [0], [0]]))
+    Rt_right = np.hstack((np.identity(3), np.zeros((3, 1))))
+    depths = np.linspace(4, 12, 9)
+    homographies = compute_homographies(K, Rt_left, K, Rt_right, depths)
+
+    # Two planes, one per half of the right view, plus some noise.
+    left = np.float32(cv2.resize(np.random.random((height // 2, width // 2,
+                                                   3)), (width, height)))
+    right = cv2.warpPerspective(left, homographies[3], (width, height))
+    right[:, width // 2:] = cv2.warpPerspective(
+        left, homographies[6], (width, height))[:, width // 2:]
+    right += np.float32(0.05 * np.random.random(right.shape))
+
+    right_normalized = preprocess_ncc(right, ncc_size)
+    dense = StreamingArgmax(height, width)
+    for pos, H in enumerate(homographies):
+        _, ncc = sweep_layer(left, right_normalized, H, width, height,
+                             ncc_size)
+        dense.update(pos, ncc)
+
+    # A band covering every label makes the refinement exhaustive.
+    labels, best, _ = hierarchical_plane_sweep(
+        left, right, depths, K, Rt_left, K, Rt_right, ncc_size, levels=2,
+        band=len(depths))
+
+    half = ncc_size // 2
+    inner = (slice(half, -half), slice(half, -half))
+    assert len(np.unique(dense.label[inner])) > 1
+    assert (labels[inner] == dense.label[inner]).all()
+    assert np.allclose(best[inner], dense.best[inner], atol=1e-5)
+
+
+@skip_not_implemented
+def upsample_labels_test():
+    labels = np.array(((9, 1, 1, 2), (1, 1, 2, 2), (3, 3, 2, 7)))
+    best = np.ones((3, 4), dtype=np.float32)
+    best[0, 0] = 0
+    best[2, 3] = -0.5
+
+    # Unscored pixels borrow their nearest scored neighbor's label, and odd
+    # sizes crop the last repeated row and column.
+    up = _upsample_labels(labels, best, 5, 7)
+    filled = np.array(((1, 1, 1, 2), (1, 1, 2, 2), (3, 3, 2, 2)))
+    assert up.shape == (5, 7)
+    assert (up == np.repeat(np.repeat(filled, 2, axis=0), 2,
+                            axis=1)[:5, :7]).all()
+
+    # With nothing scored there is nothing to borrow from.
+    up = _upsample_labels(labels, np.zeros((3, 4)), 6, 8)
+    assert (up == np.repeat(np.repeat(labels, 2, axis=0), 2, axis=1)).all()
+
+
+@skip_not_implemented
+def aggregate_ncc_test():
+    scores = np.array([[[0.5]], [[-1.0]], [[0.9]], [[0.7]]])
+    assert np.allclose(aggregate_ncc(scores), 0.275)
+    assert np.allclose(aggregate_ncc(scores, 'trimmed'), 0.6)
+    # With two views there is nothing left to trim.
+    assert np.allclose(aggregate_ncc(scores[:2], 'trimmed'), -0.25)
+
+
+@skip_not_implemented
+def stage_timer_test():
+    timer = StageTimer()
+
+    for i in range(3):
+        with timer.stage('warp', pixels=1000000):
+            pass
+    timer.merge({'warp': {'seconds': 2.0, 'calls': 1, 'pixels': 1000000}})
+    timer.add('ncc', 0.5, pixels=2000000)
+
+    report = timer.report()
+
+    assert report['warp']['calls'] == 4
+    assert report['warp']['mpixel_layers'] == 4
+    assert report['warp']['seconds'] >= 2
+    assert report['ncc']['mpixel_layers_per_second'] == 4
+
+
+@skip_not_implemented
+def form_poisson_equation_test():
+    height = 2
+    width = 3
+    alpha = np.ones((height, width), dtype=np.float32)
+    alpha[1, 2] = 0
+    normals = np.zeros((height, width, 3), dtype=np.float32)
+    normals[:, :, 0] = 0.25
+    normals[:, :, 1] = -0.5
+    normals[:, :, 2] = -2
+    depth = np.arange(height * width, dtype=np.float32).reshape(height, width)
+
+    A, b = form_poisson_equation(height, width, alpha, normals, 3.0, depth)
+    A = A.toarray()
+
+    # Three x pairs, two y pairs and five depth rows.
+    assert A.shape == (10, 6)
+    assert A.dtype == np.float32 and b.dtype == np.float32
+    pairs = ((0, 1), (1, 2), (3, 4), (0, 3), (1, 4))
+    for row, (first, second) in enumerate(pairs):
+        expected = np.zeros(6)
+        expected[first] = -2
+        expected[second] = 2
+        assert (A[row] == expected).all()
+    assert (b[:3] == -0.25).all()
+    assert (b[3:5] == -0.5).all()
+
+    assert (A[5:, :5] == 3 * np.identity(5)).all()
+    assert (A[5:, 5] == 0).all()
+    assert (b[5:] == 3 * np.arange(5)).all()
+
+    A, b = form_poisson_equation(height, width, alpha, normals, None, None)
+    assert A.shape == (5, 6)
+
+
+@skip_not_implemented
+def solvers_agree_test():
+    height = 12
+    width = 15
+    alpha = np.ones((height, width), dtype=np.float32)
+    alpha[4:7, 5:9] = 0
+    normals = np.float32(np.random.normal(size=(height, width, 3)))
+    normals[:, :, 2] = -np.abs(normals[:, :, 2]) - 1
+    normals /= np.linalg.norm(normals, axis=2, keepdims=True)
+    depth = np.float32(np.random.random((height, width)))
+
+    A, b = form_poisson_equation(height, width, alpha, normals, 0.5, depth)
+    expected = np.linalg.lstsq(A.toarray(), b, rcond=None)[0]
+
+    for name, solver in SOLVERS.items():
+        result = solver(A, b, tol=1e-12, maxiter=10000,
+                        shape=(height, width))
+        assert result.x.shape == (height * width,)
+        assert np.allclose(result.x, expected, atol=1e-4), name
+        assert result.iterations >= 1
+        assert result.seconds >= 0
+        assert abs(result.residual - np.linalg.norm(A.dot(expected) - b)) \
+            < 1e-4
+
+
+@skip_not_implemented
+def poisson_operator_matches_matrix_test():
+    height = 9
+    width = 11
+    alpha = np.float32(np.random.random((height, width)) > 0.3)
+    normals = np.float32(np.random.normal(size=(height, width, 3)))
+    depth = np.float32(np.random.random((height, width)))
+
+    for args in ((normals, None, None), (None, 0.5, depth),
+                 (normals, 2.0, depth)):
+        A, b = form_poisson_equation(height, width, alpha, *args)
+        operator, b_operator = form_poisson_operator(height, width, alpha,
+                                                     *args)
+        assert operator.shape == A.shape
+        assert (b_operator == b).all()
+
+        A = A.astype(np.float64)
+        x = np.random.random(height * width)
+        y = np.random.random(A.shape[0])
+        assert np.allclose(operator.matvec(x), A.dot(x))
+        assert np.allclose(operator.rmatvec(y), A.T.dot(y))
+        assert np.allclose(operator.normal_diagonal(),
+                           A.T.dot(A).diagonal())
+
+        for name in MATRIX_FREE:
+            expected = SOLVERS[name](A, b, tol=1e-12, maxiter=10000)
+            result = SOLVERS[name](operator, b, tol=1e-12, maxiter=10000)
+            assert np.allclose(result.x, expected.x, atol=1e-6), name
+
+
+@skip_not_implemented
+def multigrid_matches_direct_test():
+    height = 70
+    width = 83
+    ys, xs = np.mgrid[0:height, 0:width]
+    alpha = np.float32((ys - 35) ** 2 + (xs - 40) ** 2 < 30 ** 2)
+    alpha[30:40, 10:60] = 0
+    normals = np.float32(np.random.normal(size=(height, width, 3)))
+    normals[:, :, 2] = -np.abs(normals[:, :, 2]) - 2
+    normals /= np.linalg.norm(normals, axis=2, keepdims=True)
+    depth = np.float32(np.random.random((height, width)))
+
+    for depth_weight, depth_term in ((None, None), (0.1, depth)):
+        A, b = form_poisson_equation(height, width, alpha, normals,
+                                     depth_weight, depth_term)
+        expected = SOLVERS['direct'](A, b)
+        result = SOLVERS['multigrid'](A, b, tol=1e-10, shape=(height, width))
+
+        # A handful of V-cycles is enough, independent of the grid size.
+        assert result.iterations < 30
+        assert np.allclose(result.x, expected.x, atol=1e-4)
+        assert (result.x[alpha.ravel() == 0] == 0).all()
+
+
+@skip_not_implemented
+def multigrid_grazing_normals_test():
+    # Near-zero nz over half of the mask plus a depth term makes the coarse
+    # Galerkin operators much stiffer than the fine one, which is where a
+    # fixed Jacobi damping diverges.
+    height = 300
+    width = 350
+    ys, xs = np.mgrid[0:height, 0:width]
+    alpha = np.float32((ys / height - 0.5) ** 2 + (xs / width - 0.5) ** 2 < 0.2)
+    normals = np.float32(np.random.normal(size=(height, width, 3)))
+    normals[:, :, 2] = -np.where(xs < width / 2, 0.02, 1.0) * \
+        np.random.uniform(0.01, 1, size=(height, width))
+    normals /= np.linalg.norm(normals, axis=2, keepdims=True)
+    depth = np.float32(np.random.random((height, width)))
+
+    A, b = form_poisson_equation(height, width, alpha, normals, 1, depth)
+    expected = SOLVERS['direct'](A, b)
+    result = SOLVERS['multigrid'](A, b, tol=1e-10, maxiter=100,
+                                  shape=(height, width))
+
+    assert result.iterations < 20
+    assert np.allclose(result.x, expected.x, atol=1e-6)
+
+
+@skip_not_implemented
+def integrate_normals_dct_test():
+    height = 24
+    width = 31
+    # With a constant nz the spectral and sparse solutions coincide.
+    normals = np.float32(np.random.normal(size=(height, width, 3)))
+    normals[:, :, 2] = -1.5
+    alpha = np.ones((height, width), dtype=np.float32)
+    A, b = form_poisson_equation(height, width, alpha, normals, None, None)
+
+    expected = SOLVERS['direct'](A, b).x
+    result = integrate_normals_dct(normals)
+    assert result.x.shape == (height * width,)
+    assert np.allclose(result.x - result.x.mean(),
+                       expected - expected.mean(), atol=1e-5)
+    assert abs(result.residual - np.linalg.norm(A.dot(result.x) - b)) < 1e-4
+
+    # A plane is recovered exactly, up to its offset.
+    ys, xs = np.mgrid[0:height, 0:width]
+    plane = 0.3 * xs - 0.2 * ys
+    normals = np.dstack((np.full((height, width), -0.3),
+                         np.full((height, width), -0.2),
+                         -np.ones((height, width))))
+    depth = integrate_normals_dct(normals).x.reshape(height, width)
+    assert np.allclose(depth - depth.mean(), plane - plane.mean())
+
+
+@skip_not_implemented
+def save_mesh_binary_matches_ascii_test():
+    height = 6
+    width = 7
+    alpha = np.ones((height, width), dtype=np.float32)
+    alpha[2, 3] = 0
+    depth = np.float32(np.random.random((height, width)) + 1)
+    normals = np.float32(np.random.normal(size=(height, width, 3)))
+    albedo = np.float32(np.random.random((height, width, 3)))
+    K = np.array(((10.0, 0, 3), (0, 10.0, 2), (0, 0, 1)))
+
+    directory = tempfile.mkdtemp()
+    try:
+        ascii_ply = os.path.join(directory, 'ascii.ply')
+        binary_ply = os.path.join(directory, 'binary.ply')
+        save_mesh(K, width, height, albedo, normals, depth, alpha, ascii_ply)
+        save_mesh(K, width, height, albedo, normals, depth, alpha,
+                  binary_ply, binary=True)
+
+        with open(ascii_ply) as f:
+            lines = f.read().split('\n')
+        with open(binary_ply, 'rb') as f:
+            data = f.read()
+    finally:
+        shutil.rmtree(directory)
+
+    end = lines.index('end_header') + 1
+    offset = data.index(b'end_header\n') + len(b'end_header\n')
+    header = data[:offset].decode('ascii').split('\n')[:-1]
+    assert header[1] == 'format binary_little_endian 1.0'
+    assert header[2:] == lines[2:end]
+
+    vertex = np.dtype([('position', '<f4', (6,)), ('color', 'u1', (3,))])
+    face = np.dtype([('count', 'u1'), ('indices', '<i4', (4,))])
+    vertex_count = height * width - 1
+    # Four of the quads touch the masked pixel.
+    face_count = (height - 1) * (width - 1) - 4
+    assert len(data) == offset + vertex_count * vertex.itemsize + \
+        face_count * face.itemsize
+
+    vertices = np.frombuffer(data, vertex, vertex_count, offset)
+    faces = np.frombuffer(data, face, face_count,
+                          offset + vertex_count * vertex.itemsize)
+
+    expected = np.array([line.split() for line in lines[end:]
+                         if line.split()[0] != '4'], dtype=np.float64)
+    assert np.allclose(vertices['position'], expected[:, :6], atol=1e-5)
+    assert (vertices['color'] == expected[:, 6:]).all()
+
+    expected = np.array([line.split() for line in lines[end:]
+                         if line.split()[0] == '4'], dtype=np.int64)
+    assert (faces['count'] == 4).all()
+    assert (faces['indices'] == expected[:, 1:]).all()
+
+
+@skip_not_implemented
+def build_mesh_test():
+    height = 5
+    width = 6
+    alpha = np.ones((height, width), dtype=np.float32)
+    alpha[0, 0] = 0
+    alpha[3, 4] = 0
+    depth = np.float32(np.random.random((height, width)) + 1)
+    K = np.array(((10.0, 0, 3), (0, 10.0, 2), (0, 0, 1)))
+
+    mesh = build_mesh(K, width, height, None, None, depth, alpha)
+    valid = np.argwhere(alpha != 0)
+    assert mesh.vertices.shape == (height * width - 2, 3)
+    assert (mesh.colors == 255).all()
+    assert (mesh.normals == (0, 0, -1)).all()
+
+    pixels = np.stack((valid[:, 1], valid[:, 0], np.ones(len(valid))), axis=1)
+    expected = pixels.dot(np.linalg.inv(K).T) * \
+        depth[valid[:, 0], valid[:, 1]][:, np.newaxis]
+    assert np.allclose(mesh.vertices, expected, atol=1e-5)
+
+    # One quad touches the corner pixel and four touch the inner one.
+    assert mesh.faces.shape == ((height - 1) * (width - 1) - 5, 4)
+    index = {tuple(pixel): i for i, pixel in enumerate(valid.tolist())}
+    assert mesh.faces[0].tolist() == [index[0, 1], index[1, 1], index[1, 2],
+                                      index[0, 2]]
+
+    split = build_mesh(K, width, height, None, None, depth, alpha,
+                       triangles=True)
+    assert np.array_equal(split.vertices, mesh.vertices)
+    assert split.faces.shape == (2 * len(mesh.faces), 3)
+    assert (split.faces[0::2] == mesh.faces[:, :3]).all()
+    assert (split.faces[1::2] == mesh.faces[:, [0, 2, 3]]).all()
+
+
+@skip_not_implemented
+def build_mesh_grayscale_albedo_test():
+    height = 3
+    width = 4
+    alpha = np.ones((height, width), dtype=np.float32)
+    depth = np.ones((height, width), dtype=np.float32)
+    albedo = np.float32(np.random.random((height, width, 1)))
+    rgb = np.dstack(3 * [albedo])
+
+    expected = build_mesh(None, width, height, rgb, None, depth, alpha)
+    for gray in (albedo, albedo[:, :, 0]):
+        mesh = build_mesh(None, width, height, gray, None, depth, alpha)
+        assert mesh.colors.shape == (height * width, 3)
+        assert (mesh.colors == expected.colors).all()
+
+
 @skip_not_implemented
 def pyrdown_even_test():
     height = 16
@@ -300,3 +1121,81 @@ def compute_photometric_stereo_half_albedo_test():
 
     assert np.allclose(albedo[0, 0, 0], 0.5)
     assert (normals[0, 0, :] == (0, 0, 1)).all()
+
+
+@skip_not_implemented
+def compute_photometric_stereo_color_test():
+    height = 4
+    width = 5
+    lights = np.array(((0.0, 0.6, -0.6, 0.0), (0.0, 0.0, 0.0, 0.6),
+                       (1.0, 0.8, 0.8, 0.8)))
+    normal = np.array((0.1, -0.2, 1.0))
+    normal /= np.linalg.norm(normal)
+    expected_albedo = np.random.uniform(0.2, 1, size=(height, width, 3))
+    images = [np.float32(expected_albedo * normal.dot(light))
+              for light in lights.T]
+
+    albedo, normals = compute_photometric_stereo(lights, images)
+
+    assert albedo.dtype == np.float32 and normals.dtype == np.float32
+    assert np.allclose(albedo, expected_albedo, atol=1e-5)
+    assert np.allclose(normals, normal, atol=1e-5)
+
+
+@skip_not_implemented
+def compute_photometric_stereo_bands_test():
+    height = 9
+    width = 7
+    lights = np.random.normal(size=(3, 5))
+    lights[2] = np.abs(lights[2]) + 1
+    lights /= np.linalg.norm(lights, axis=0)
+    images = [np.float32(np.random.uniform(0, 255, size=(height, width, 3)))
+              for _ in range(5)]
+
+    albedo, normals = compute_photometric_stereo(lights, images)
+    # Two rows per band, so the last band is short.
+    max_bytes = 2 * width * 4 * (5 * 4 + 4 * 3 + 8)
+    assert photometric_stereo_rows(width, 5, 3, max_bytes) == 2
+    banded_albedo, banded_normals = compute_photometric_stereo(
+        lights, images, max_bytes)
+
+    assert np.allclose(banded_albedo, albedo)
+    assert np.allclose(banded_normals, normals)
+    assert np.isclose(
+        rerendering_error(lights, images, albedo, normals, max_bytes),
+        rerendering_error(lights, images, albedo, normals))
+
+
+@skip_not_implemented
+def compute_robust_photometric_stereo_test():
+    height = 6
+    width = 5
+    count = 8
+    lights = np.random.normal(size=(3, count))
+    lights[2] = np.abs(lights[2]) + 2
+    lights /= np.linalg.norm(lights, axis=0)
+    normal = np.array((0.2, 0.1, 1.0))
+    normal /= np.linalg.norm(normal)
+    expected_albedo = np.random.uniform(0.5, 1, size=(height, width, 3))
+    images = [np.float32(expected_albedo * normal.dot(light))
+              for light in lights.T]
+    # A cast shadow and a highlight on different lights at every pixel.
+    images[0][:] = 0
+    images[3][:] += 10
+
+    albedo, normals = compute_photometric_stereo(lights, images)
+    assert not np.allclose(normals, normal, atol=1e-2)
+
+    albedo, normals = compute_robust_photometric_stereo(lights, images)
+    assert np.allclose(albedo, expected_albedo, atol=1e-4)
+    assert np.allclose(normals, normal, atol=1e-4)
+
+    banded_albedo, banded_normals = compute_photometric_stereo(
+        lights, images, max_bytes=1, trim=1)
+    assert np.allclose(banded_albedo, albedo)
+    assert np.allclose(banded_normals, normals)
+
+    plain = compute_photometric_stereo(lights, images)
+    untrimmed = compute_robust_photometric_stereo(lights, images, trim=0)
+    assert np.allclose(untrimmed[0], plain[0], atol=1e-4)
+    assert np.allclose(untrimmed[1], plain[1], atol=1e-5)
@@ -0,0 +1,68 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class StageTimer(object):
+    """
+    Accumulates wall-clock time, call counts and pixel throughput for named
+    stages of a computation.  Pixels are counted in pixel-layers, i.e. a
+    stage that handles one full depth layer of a height x width image adds
+    height * width.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, pixels=0):
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - tic, 1, pixels)
+
+    def add(self, name, seconds, calls=1, pixels=0):
+        totals = self.stages.setdefault(
+            name, {'seconds': 0.0, 'calls': 0, 'pixels': 0})
+        totals['seconds'] += seconds
+        totals['calls'] += calls
+        totals['pixels'] += int(pixels)
+
+    def merge(self, stages):
+        """
+        Fold in the stages of another timer, e.g. one run in a worker
+        process.
+        """
+        for name, totals in stages.items():
+            self.add(name, totals['seconds'], totals['calls'],
+                     totals['pixels'])
+
+    def report(self):
+        report = {}
+        for name, totals in self.stages.items():
+            seconds = totals['seconds']
+            throughput = None
+            if seconds > 0 and totals['pixels']:
+                throughput = totals['pixels'] / seconds / 1e6
+            report[name] = {
+                'seconds': seconds,
+                'calls': totals['calls'],
+                'mpixel_layers': totals['pixels'] / 1e6,
+                'mpixel_layers_per_second': throughput,
+            }
+        return report
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def stage(timer, name, pixels=0):
+    """
+    timer.stage(name, pixels), or a no-op context when timer is None so
+    that callers can be instrumented unconditionally.
+    """
+    if timer is None:
+        return nullcontext()
+    return timer.stage(name, pixels)
@@ -1,24 +1,66 @@
 import numpy as np
 from math import floor
+from collections import namedtuple
 import cv2
 import time
+from timing import stage
+from camera import Camera
 from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import LinearOperator
 from student import compute_photometric_stereo_impl, pyrup_impl, \
     pyrdown_impl, project_impl, unproject_corners_impl, \
     preprocess_ncc_impl, compute_ncc_impl
 
-def rerendering_error(lights, images, albedo, normals):
-    errors = []
-    for light, image in zip(lights.T, images):
-        rerendered = albedo * \
-            np.tensordot(normals, light.T, axes=1)[:, :, np.newaxis]
-        error = (image - rerendered) / 255
-        errors.append(np.sqrt((error ** 2).mean()))
-
-    return sum(errors) / len(errors)
+def rerendering_error(lights, images, albedo, normals, max_bytes=None):
+    """
+    Mean over the lights of the RMSE between each image and its rerendering
+    albedo * (n . l), in units of 255.  With max_bytes the images are
+    compared in row bands sized by photometric_stereo_rows, so the
+    temporaries stay within about that budget.
+    """
+    height, width, channels = images[0].shape
+    rows = height if max_bytes is None else \
+        photometric_stereo_rows(width, len(images), channels, max_bytes)
+
+    squared = np.zeros(len(images))
+    for top in range(0, height, rows):
+        band = slice(top, top + rows)
+        for i, (light, image) in enumerate(zip(lights.T, images)):
+            rerendered = albedo[band] * \
+                np.tensordot(normals[band], light.T, axes=1)[:, :, np.newaxis]
+            error = (image[band] - rerendered) / 255
+            squared[i] += (error ** 2).sum()
+
+    errors = np.sqrt(squared / images[0].size)
+    return errors.sum() / len(errors)
+
+
+def _pixel_pairs(index, valid, offset, height, width):
+    """
+    Flat pixel indices of every (pixel, neighbor) pair where both pixels
+    are valid, in row-major order of the first pixel.  offset is (0, 1) for
+    the neighbor to the right and (1, 0) for the neighbor below.
+    """
+    dh, dw = offset
+    both = valid[:height - dh, :width - dw] & valid[dh:, dw:]
+    first = index[:height - dh, :width - dw][both]
+    return first, first + dh * width + dw
 
 
 def form_poisson_equation(height, width, alpha, normals, depth_weight, depth):
+    """
+    Sparse least squares system A x = b for the height x width depth map x.
+
+    With normals, every pair of horizontally or vertically adjacent pixels
+    that are both inside alpha contributes one row asking the depth
+    difference to match the slope of the normal.  With depth, every pixel
+    inside alpha contributes one row pulling it towards depth, weighted by
+    depth_weight.  Rows come in that order: x gradients, y gradients, depth,
+    each in row-major pixel order.
+
+    The rows are built from masks of the valid pixels and pairs, without
+    looping over pixels.
+    """
     assert alpha.shape == (height, width)
     assert normals is None or normals.shape == (height, width, 3)
     assert depth is None or depth.shape == (height, width)
@@ -26,76 +68,301 @@ def form_poisson_equation(height, width, alpha, normals, depth_weight, depth):
     if depth_weight is None:
         depth_weight = 1
 
-    row = 0
-    row_ind = []
-    col_ind = []
-    data_arr = []
-    b = []
+    valid = alpha != 0
+    index = np.arange(height * width).reshape(height, width)
+
+    # Gradient rows have two entries each and depth rows one.
+    pair_cols = [np.zeros((0, 2), dtype=np.int64)]
+    pair_data = [np.zeros((0, 2))]
+    pair_b = [np.zeros(0)]
     if normals is not None:
-        for h in range(height):
-            for w in range(width - 1):
-                alpha1 = alpha[h, w]
-                alpha2 = alpha[h, w + 1]
-                if not alpha1 or not alpha2:
-                    continue
-
-                row_ind.append(row)
-                col_ind.append(h * width + w)
-                nx = normals[h, w, 0]
-                nz = -normals[h, w, 2]
-                data_arr.append(-nz)
-                row_ind.append(row)
-                col_ind.append(h * width + (w + 1))
-                data_arr.append(nz)
-                b.append(-nx)
-                row += 1
-        for h in range(height - 1):
-            for w in range(width):
-                alpha1 = alpha[h, w]
-                alpha2 = alpha[h + 1, w]
-                if not alpha1 or not alpha2:
-                    continue
-
-                row_ind.append(row)
-                col_ind.append(h * width + w)
-                ny = -normals[h, w, 1]
-                nz = -normals[h, w, 2]
-                data_arr.append(-nz)
-                row_ind.append(row)
-                col_ind.append((h + 1) * width + w)
-                data_arr.append(nz)
-                b.append(-ny)
-                row += 1
+        nz = -normals[:, :, 2]
+        # x gradients match -nx / nz and y gradients ny / nz, with
+        # ny = -normals[:, :, 1].
+        for offset, axis, sign in (((0, 1), 0, -1), ((1, 0), 1, 1)):
+            first, second = _pixel_pairs(index, valid, offset, height, width)
+            h, w = np.divmod(first, width)
+            pair_cols.append(np.stack((first, second), axis=1))
+            pair_data.append(np.stack((-nz[h, w], nz[h, w]), axis=1))
+            pair_b.append(sign * normals[h, w, axis])
+
+    pairs = sum(len(cols) for cols in pair_cols)
+    row_ind = [np.repeat(np.arange(pairs), 2)]
+    col_ind = [cols.ravel() for cols in pair_cols]
+    data_arr = [values.ravel() for values in pair_data]
+    b = pair_b
+    row = pairs
+
     if depth is not None:
-        for h in range(height):
-            for w in range(width):
-                if not alpha[h, w]:
-                    continue
-
-                row_ind.append(row)
-                col_ind.append(h * width + w)
-                data_arr.append(depth_weight)
-                b.append(depth_weight * depth[h, w])
-                row += 1
-    row_ind = np.array(row_ind, dtype=np.int32)
-    col_ind = np.array(col_ind, dtype=np.int32)
-    data_arr = np.array(data_arr, dtype=np.float32)
-    b = np.array(b, dtype=np.float32)
+        pixels = index[valid]
+        row_ind.append(row + np.arange(len(pixels)))
+        col_ind.append(pixels)
+        data_arr.append(np.full(len(pixels), depth_weight))
+        b.append(depth_weight * depth[valid])
+        row += len(pixels)
+
+    row_ind = np.concatenate(row_ind).astype(np.int32)
+    col_ind = np.concatenate(col_ind).astype(np.int32)
+    data_arr = np.concatenate(data_arr).astype(np.float32)
+    b = np.concatenate(b).astype(np.float32)
 
     A = csr_matrix((data_arr, (row_ind, col_ind)), shape=(row, width * height))
 
     return A, b
 
 
-def compute_photometric_stereo(lights, images):
-    return compute_photometric_stereo_impl(lights, images)
+class PoissonOperator(LinearOperator):
+    """
+    Matrix-free version of the matrix A from form_poisson_equation, with
+    the same rows in the same order.  Products with A and A^T are computed
+    with array slicing over the height x width grid, so memory scales with
+    the number of pixels instead of the number of nonzeros.  Coefficients
+    are rounded to float32 like the entries of A, and products are float64.
+    """
+
+    def __init__(self, height, width, alpha, normals, depth_weight, depth):
+        assert alpha.shape == (height, width)
+        assert normals is None or normals.shape == (height, width, 3)
+        assert depth is None or depth.shape == (height, width)
+
+        if depth_weight is None:
+            depth_weight = 1
+
+        valid = alpha != 0
+        self.grid = (height, width)
+        self.nz = None
+        self.pixels = None
+        rows = 0
+        if normals is not None:
+            self.nz = np.float64(np.float32(-normals[:, :, 2]))
+            self.pairs_x = valid[:, :-1] & valid[:, 1:]
+            self.pairs_y = valid[:-1] & valid[1:]
+            self.count_x = np.count_nonzero(self.pairs_x)
+            self.count_y = np.count_nonzero(self.pairs_y)
+            rows += self.count_x + self.count_y
+        if depth is not None:
+            self.weight = np.float64(np.float32(depth_weight))
+            self.pixels = valid
+            rows += np.count_nonzero(valid)
+
+        super(PoissonOperator, self).__init__(np.float64,
+                                              (rows, height * width))
+
+    def _matvec(self, x):
+        x = np.reshape(x, self.grid)
+        parts = [np.zeros(0)]
+        if self.nz is not None:
+            dx = self.nz[:, :-1] * (x[:, 1:] - x[:, :-1])
+            dy = self.nz[:-1] * (x[1:] - x[:-1])
+            parts += [dx[self.pairs_x], dy[self.pairs_y]]
+        if self.pixels is not None:
+            parts.append(self.weight * x[self.pixels])
+        return np.concatenate(parts)
+
+    def _rmatvec(self, y):
+        y = np.ravel(y)
+        height, width = self.grid
+        x = np.zeros(self.grid)
+        start = 0
+        if self.nz is not None:
+            dx = np.zeros((height, width - 1))
+            dx[self.pairs_x] = y[:self.count_x]
+            dx *= self.nz[:, :-1]
+            x[:, :-1] -= dx
+            x[:, 1:] += dx
+
+            start = self.count_x + self.count_y
+            dy = np.zeros((height - 1, width))
+            dy[self.pairs_y] = y[self.count_x:start]
+            dy *= self.nz[:-1]
+            x[:-1] -= dy
+            x[1:] += dy
+        if self.pixels is not None:
+            x[self.pixels] += self.weight * y[start:]
+        return x.ravel()
+
+    def normal_diagonal(self):
+        """
+        The diagonal of A^T A, i.e. the squared norm of every column.
+        """
+        diagonal = np.zeros(self.grid)
+        if self.nz is not None:
+            dx = np.where(self.pairs_x, np.square(self.nz[:, :-1]), 0)
+            dy = np.where(self.pairs_y, np.square(self.nz[:-1]), 0)
+            diagonal[:, :-1] += dx
+            diagonal[:, 1:] += dx
+            diagonal[:-1] += dy
+            diagonal[1:] += dy
+        if self.pixels is not None:
+            diagonal[self.pixels] += np.square(self.weight)
+        return diagonal.ravel()
+
+
+def form_poisson_operator(height, width, alpha, normals, depth_weight,
+                          depth):
+    """
+    Matrix-free counterpart of form_poisson_equation.  Returns a
+    PoissonOperator in place of the CSR matrix and the same float32 b.
+    """
+    A = PoissonOperator(height, width, alpha, normals, depth_weight, depth)
+
+    b = [np.zeros(0, dtype=np.float32)]
+    if A.nz is not None:
+        b.append(-normals[:, :-1, 0][A.pairs_x])
+        b.append(normals[:-1, :, 1][A.pairs_y])
+    if A.pixels is not None:
+        b.append((1 if depth_weight is None else depth_weight) *
+                 depth[A.pixels])
+    b = np.concatenate(b).astype(np.float32)
+
+    return A, b
 
 
-def project(K, Rt, points):
+def _solve_3x3(M, rhs):
+    """
+    Solve the P x 3 x 3 systems M x = rhs with the adjugate.  Returns x and
+    the determinants; x is meaningless where the determinant is near zero.
+    """
+    (a, b, c), (d, e, f), (g, h, i) = M.transpose(1, 2, 0)
+    adjugate = np.stack((e * i - f * h, c * h - b * i, b * f - c * e,
+                         f * g - d * i, a * i - c * g, c * d - a * f,
+                         d * h - e * g, b * g - a * h, a * e - b * d), axis=1)
+    det = a * adjugate[:, 0] + b * adjugate[:, 3] + c * adjugate[:, 6]
+    x = np.einsum('pkl,pl->pk', adjugate.reshape(-1, 3, 3), rhs)
+    return x / np.where(det == 0, 1, det)[:, np.newaxis], det
+
+
+def compute_robust_photometric_stereo(lights, images, trim=1):
+    """
+    Photometric stereo as in compute_photometric_stereo_impl, but every
+    pixel ignores its trim darkest and trim brightest observations, which
+    are where cast shadows and specular highlights end up.  Observations are
+    ranked by their intensity summed over channels.  trim=0 keeps every
+    light and matches the plain solve.
+
+    Each pixel then has its own 3 x 3 normal equations
+    sum_j w_j l_j l_j^T g = sum_j w_j I_j l_j over the kept lights.  They
+    are formed for all pixels with two GEMMs and solved in closed form.
+    Pixels whose kept lights do not span 3D, for example because of ties,
+    fall back to all the lights.
+
+    Input:
+        lights -- 3 x N unit light directions
+        images -- list of N height x width x channels images
+        trim -- observations to drop at each end, with N - 2 trim >= 3
+    Output:
+        albedo, normals as from compute_photometric_stereo_impl
+    """
+    height, width, channels = images[0].shape
+    n = len(images)
+    pixels = height * width
+    assert trim >= 0 and n - 2 * trim >= 3
+
+    I = np.stack(images).astype(np.float32, copy=False).reshape(
+        n, pixels, channels)
+    brightness = I.reshape(n * pixels, channels).dot(
+        np.ones(channels, dtype=np.float32)).reshape(n, pixels)
+
+    # Keep what lies strictly between the trim-th darkest and brightest
+    # observation of every pixel, so ties with a dropped one go too.
+    weights = np.ones((n, pixels), dtype=np.float32)
+    if trim > 0:
+        ordered = np.sort(brightness, axis=0)
+        weights *= (brightness > ordered[trim - 1]) & \
+            (brightness < ordered[n - trim])
+
+    lights = np.asarray(lights, dtype=np.float64)
+    lights32 = np.float32(lights)
+    outer = np.einsum('kj,lj->jkl', lights32, lights32).reshape(n, 9)
+    M = weights.T.dot(outer).reshape(pixels, 3, 3)
+    rhs = (weights * brightness).T.dot(lights32.T)
+
+    G, det = _solve_3x3(M, rhs)
+    singular = np.abs(det) < 1e-6
+    if singular.any():
+        weights[:, singular] = 1
+        G[singular] = brightness[:, singular].T.dot(
+            np.float32(np.linalg.pinv(lights)))
+
+    kd = np.linalg.norm(G, axis=1)
+    normals = G / np.where(kd == 0, 1, kd)[:, np.newaxis]
+
+    # Per-channel least squares albedo over the kept lights.
+    shading = lights32.T.dot(normals.T) * weights
+    num = np.einsum('jp,jpc->pc', shading, I)
+    den = np.einsum('jp,jp->p', shading, shading)
+    albedo = num / np.where(den == 0, 1, den)[:, np.newaxis]
+
+    mask = np.linalg.norm(albedo, axis=1) < 1e-7
+    albedo[mask] = 0
+    normals[mask] = 0
+
+    return (albedo.reshape(height, width, channels),
+            normals.reshape(height, width, 3))
+
+
+def photometric_stereo_rows(width, count, channels, max_bytes, trim=0):
+    """
+    Rows per band for photometric stereo on count width x channels images
+    so that the float32 temporaries of a band fit in max_bytes: the stacked
+    band, G before the channel sum, the shading and the outputs, plus the
+    brightness, weights and 3 x 3 systems of the robust solve when trim is
+    positive.  Always at least one row.
+    """
+    per_pixel = 4 * (count * (channels + 1) + 4 * channels + 8)
+    if trim > 0:
+        per_pixel += 4 * (3 * count + 24)
+    return max(1, int(max_bytes // (per_pixel * width)))
+
+
+def compute_photometric_stereo(lights, images, max_bytes=None, trim=0):
+    """
+    compute_photometric_stereo_impl, or compute_robust_photometric_stereo
+    when trim is positive, optionally over row bands.  Every pixel is solved
+    independently, so with max_bytes the image is split into bands of
+    photometric_stereo_rows rows that are solved one at a time into
+    preallocated albedo and normals.  The input images are sliced, not
+    copied.
+    """
+    def solve(images):
+        if trim > 0:
+            return compute_robust_photometric_stereo(lights, images, trim)
+        return compute_photometric_stereo_impl(lights, images)
+
+    if max_bytes is None:
+        return solve(images)
+
+    height, width, channels = images[0].shape
+    rows = photometric_stereo_rows(width, len(images), channels, max_bytes,
+                                   trim)
+
+    albedo = np.empty((height, width, channels), dtype=np.float32)
+    normals = np.empty((height, width, 3), dtype=np.float32)
+    for top in range(0, height, rows):
+        band = slice(top, top + rows)
+        albedo[band], normals[band] = solve(
+            [image[band] for image in images])
+
+    return albedo, normals
+
+
+def project(K, Rt, points=None):
+    """
+    project(K, Rt, points), or project(camera, points) with a
+    camera.Camera.
+    """
+    if isinstance(K, Camera):
+        return K.project(Rt)
     return project_impl(K, Rt, points)
 
 
-def unproject_corners(K, width, height, depth, Rt):
+def unproject_corners(K, width, height, depth, Rt=None):
+    """
+    unproject_corners(K, width, height, depth, Rt), or
+    unproject_corners(camera, width, height, depth) with a camera.Camera.
+    """
+    if isinstance(K, Camera):
+        return K.unproject_corners(width, height, depth)
     return unproject_corners_impl(K, width, height, depth, Rt)
 
 
@@ -113,6 +380,376 @@ def preprocess_ncc(image, ncc_size):
     return preprocess_ncc_impl(image, ncc_size)
 
 
+NccBoxStats = namedtuple('NccBoxStats', ['image', 'mean', 'norm', 'ncc_size'])
+
+
+def _box_sum(image, ncc_size):
+    """
+    Sum every ncc_size x ncc_size window of image with separable running
+    sums.  Windows that extend past the border are left as zero.
+    """
+    height, width = image.shape[:2]
+    half = ncc_size // 2
+    total = np.zeros(image.shape, dtype=np.float64)
+    if height < ncc_size or width < ncc_size:
+        return total
+
+    csum = np.cumsum(image, axis=0, dtype=np.float64)
+    rows = csum[ncc_size - 1:].copy()
+    rows[1:] -= csum[:-ncc_size]
+
+    csum = np.cumsum(rows, axis=1)
+    window = csum[:, ncc_size - 1:].copy()
+    window[:, 1:] -= csum[:, :-ncc_size]
+
+    total[half:height - half, half:width - half] = window
+    return total
+
+
+def _centered_window_sum(image1, mean1, image2, mean2, ncc_size):
+    """
+    For every ncc_size x ncc_size window, the sum over its pixels and
+    channels of (image1 - mean1) * (image2 - mean2), with the means taken at
+    the window center.  The sum is accumulated one window offset at a time
+    from values that are already centered, so unlike sum(x y) - n mean(x)
+    mean(y) nothing cancels, however dark or flat the patch.  Like
+    preprocess_ncc it works in float32.  Windows that extend past the
+    border are left as zero.
+    """
+    height, width = image1.shape[:2]
+    half = ncc_size // 2
+    total = np.zeros((height, width), dtype=np.float32)
+    if height < ncc_size or width < ncc_size:
+        return total
+
+    # Channels first, so every offset works on contiguous planes.
+    inner_height = height - ncc_size + 1
+    inner_width = width - ncc_size + 1
+    inner = (slice(half, height - half), slice(half, width - half))
+
+    def planes(image):
+        return np.ascontiguousarray(image.transpose(2, 0, 1),
+                                    dtype=np.float32)
+
+    image1 = planes(image1)
+    image2 = planes(image2)
+    center1 = planes(mean1[inner])
+    center2 = planes(mean2[inner])
+
+    window = np.empty_like(center1)
+    centered = np.empty_like(center2)
+    accumulated = total[inner]
+    for dy in range(ncc_size):
+        for dx in range(ncc_size):
+            rows = slice(dy, dy + inner_height)
+            cols = slice(dx, dx + inner_width)
+            np.subtract(image1[:, rows, cols], center1, out=window)
+            np.subtract(image2[:, rows, cols], center2, out=centered)
+            window *= centered
+            for channel in window:
+                accumulated += channel
+    return total
+
+
+def preprocess_ncc_box(image, ncc_size):
+    """
+    Box-filter counterpart of preprocess_ncc.  Instead of materializing the
+    height x width x (channels * ncc_size**2) patch vectors, keep the image,
+    the per-channel patch means from windowed running sums and the joint
+    patch norm.  Memory is O(height * width * channels).
+
+    The norm comes from _centered_window_sum rather than from the sum of
+    squares, so the low-contrast patches of dark image regions keep their
+    exact norm.  As in preprocess_ncc, patches with a norm below 1e-6, or
+    that cross the image border, get a zero norm and score zero in
+    compute_ncc_box.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    n = ncc_size * ncc_size
+
+    mean = np.float32(_box_sum(image, ncc_size) / n)
+    norm = np.sqrt(_centered_window_sum(image, mean, image, mean, ncc_size))
+    norm[norm < 1e-6] = 0
+
+    return NccBoxStats(image, mean, norm, ncc_size)
+
+
+def compute_ncc_box(stats1, stats2):
+    """
+    Box-filter counterpart of compute_ncc.  Takes two results of
+    preprocess_ncc_box and returns the same height x width NCC map as
+    compute_ncc(preprocess_ncc(image1), preprocess_ncc(image2)).
+    """
+    assert stats1.ncc_size == stats2.ncc_size
+
+    cross = _centered_window_sum(stats1.image, stats1.mean, stats2.image,
+                                 stats2.mean, stats1.ncc_size)
+
+    denom = stats1.norm * stats2.norm
+    valid = denom > 0
+    ncc = np.zeros(denom.shape)
+    ncc[valid] = cross[valid] / denom[valid]
+    return ncc
+
+
+NCC_ENGINES = {
+    'patch': (preprocess_ncc, compute_ncc),
+    'box': (preprocess_ncc_box, compute_ncc_box),
+}
+
+
+def compute_homographies(K_left, Rt_left, K_right, Rt_right, depths):
+    """
+    Homographies taking left image pixels to right image pixels through
+    every plane of the sweep, all in one vectorized step.
+
+    A plane fronto-parallel to the right camera at depth d satisfies
+    n^T X = d in right camera coordinates, with n = (0, 0, 1).  With the
+    relative pose X_left = R X_right + t, the plane-induced homography from
+    right pixels to left pixels is
+
+        K_left (R + t n^T / d) K_right^-1
+
+    and the sweep needs its inverse.
+
+    Input:
+        K_left, K_right -- camera intrinsics calibration matrices
+        Rt_left, Rt_right -- 3 x 4 camera extrinsics calibration matrices
+        depths -- D depths of the swept planes
+    Output:
+        homographies -- D x 3 x 3 array, each scaled so that H[2, 2] == 1
+    """
+    R_left = np.asarray(Rt_left[:, :3], dtype=np.float64)
+    R_right = np.asarray(Rt_right[:, :3], dtype=np.float64)
+    R = R_left.dot(R_right.T)
+    t = Rt_left[:, 3] - R.dot(Rt_right[:, 3])
+
+    invK_right = np.linalg.inv(K_right)
+    depths = np.asarray(depths, dtype=np.float64)
+
+    rotation = K_left.dot(R).dot(invK_right)
+    translation = np.outer(K_left.dot(t), invK_right[2])
+    right_to_left = rotation[np.newaxis] + \
+        translation[np.newaxis] / depths[:, np.newaxis, np.newaxis]
+
+    homographies = np.linalg.inv(right_to_left)
+    return homographies / homographies[:, 2:, 2:]
+
+
+def rectified_translations(homographies, depths, atol=1e-6):
+    """
+    Detect a rectified pair.  If every homography of the sweep is a pure
+    horizontal translation, the sweep can be run over integer disparities
+    instead of depths.
+
+    The translation is affine in inverse depth, so the integer translations
+    covering the swept range are mapped back to depths through that line.
+    Labels keep the order of depths.
+
+    Input:
+        homographies -- D x 3 x 3 output of compute_homographies
+        depths -- D depths of the swept planes
+    Output:
+        None if the pair is not rectified, otherwise
+        translations -- integer x translations from left to right pixels
+        depths -- float32 depth of the plane inducing each translation
+    """
+    translation = np.tile(np.identity(3), (len(homographies), 1, 1))
+    translation[:, 0, 2] = homographies[:, 0, 2]
+    if len(depths) < 2 or not np.allclose(homographies, translation,
+                                          atol=atol):
+        return None
+
+    inverse_depths = 1.0 / np.asarray(depths, dtype=np.float64)
+    tx = homographies[:, 0, 2]
+    slope = (tx[-1] - tx[0]) / (inverse_depths[-1] - inverse_depths[0])
+    offset = tx[0] - slope * inverse_depths[0]
+
+    step = 1 if tx[-1] >= tx[0] else -1
+    first = np.ceil(tx[0]) if step > 0 else np.floor(tx[0])
+    last = np.floor(tx[-1]) if step > 0 else np.ceil(tx[-1])
+    translations = np.arange(first, last + step, step).astype(np.int64)
+
+    return translations, np.float32(slope / (translations - offset))
+
+
+def crop_normalized(normalized, rows, cols):
+    """
+    Crop the output of either NCC engine's preprocess step.  Each pixel's
+    entry only depends on its own patch, so cropping commutes with it.
+    """
+    if isinstance(normalized, NccBoxStats):
+        return NccBoxStats(normalized.image[rows, cols],
+                           normalized.mean[rows, cols],
+                           normalized.norm[rows, cols], normalized.ncc_size)
+    return normalized[rows, cols]
+
+
+def rectified_layer(left, left_normalized, right_normalized, translation,
+                    engine='patch', timer=None):
+    """
+    Rectified counterpart of sweep_layer.  Warping by a pure integer
+    translation is a column shift, so the left image is normalized once by
+    the caller and every layer is scored on shifted slices of it.
+
+    Patches that fall off either image are scored zero, including those
+    that the warped image would only partially cover.
+
+    Returns the projected left image and the height x width NCC map.
+    """
+    _, compute = NCC_ENGINES[engine]
+    height, width = left.shape[:2]
+
+    # Warping by translation samples the left image at x - translation.
+    lo = max(0, translation)
+    hi = min(width, width + translation)
+
+    projected_left = np.zeros_like(left)
+    ncc = np.zeros((height, width))
+    if lo < hi:
+        with stage(timer, 'warp', height * width):
+            projected_left[:, lo:hi] = \
+                left[:, lo - translation:hi - translation]
+        with stage(timer, 'ncc', height * width):
+            ncc[:, lo:hi] = compute(
+                crop_normalized(right_normalized, slice(None),
+                                slice(lo, hi)),
+                crop_normalized(left_normalized, slice(None),
+                                slice(lo - translation, hi - translation)))
+
+    return projected_left, ncc
+
+
+def sweep_layer(left, right_normalized, H, width, height, ncc_size,
+                engine='patch', timer=None):
+    """
+    Score one fronto-parallel plane of the sweep.  The left image is warped
+    onto the plane through the homography H from compute_homographies,
+    normalized and compared to the already normalized right image.
+
+    When a timing.StageTimer is given, the warp, NCC preprocessing and NCC
+    scoring are recorded as separate stages.
+
+    Returns the projected left image and the height x width NCC map.
+    """
+    preprocess, compute = NCC_ENGINES[engine]
+    pixels = width * height
+
+    with stage(timer, 'warp', pixels):
+        projected_left = cv2.warpPerspective(left, H, (width, height))
+
+    with stage(timer, 'preprocess', pixels):
+        left_normalized = preprocess(projected_left, ncc_size)
+    with stage(timer, 'ncc', pixels):
+        ncc = compute(right_normalized, left_normalized)
+
+    return projected_left, ncc
+
+
+NCC_AGGREGATES = ('mean', 'trimmed')
+
+
+def aggregate_ncc(scores, method='mean'):
+    """
+    Combine a stack of N x height x width NCC maps, one per view, into a
+    single map.  'mean' averages them; 'trimmed' drops the lowest and the
+    highest score at every pixel first, when there are more than two views,
+    so a single shadowed or saturated view cannot decide the match.
+    """
+    if method not in NCC_AGGREGATES:
+        raise Exception('{0} is not a valid aggregate'.format(method))
+
+    scores = np.asarray(scores)
+    if method == 'trimmed' and len(scores) > 2:
+        scores = np.sort(scores, axis=0)[1:-1]
+    return scores.mean(axis=0)
+
+
+def warp_maps(H, width, height):
+    """
+    Sampling maps for cv2.remap that reproduce
+    cv2.warpPerspective(image, H, (width, height)) on any image of the same
+    size.  Computing them once lets several images share one warp.
+    """
+    ys, xs = np.mgrid[0:height, 0:width]
+    inverse = np.linalg.inv(H)
+    points = np.einsum('ij,jkl->ikl', inverse,
+                       np.stack((xs, ys, np.ones_like(xs))))
+    map_x = np.float32(points[0] / points[2])
+    map_y = np.float32(points[1] / points[2])
+    return map_x, map_y
+
+
+def multi_sweep_layer(lefts, rights_normalized, H, width, height, ncc_size,
+                      engine='patch', aggregate='mean', timer=None):
+    """
+    Score one plane of the sweep against several views of the same scene,
+    e.g. the same stereo pair under different lighting.  The sampling maps
+    for H are built once and every left view is remapped through them, so
+    the extra views only add the remap and NCC work.  The per-view NCC maps
+    are combined with aggregate_ncc.
+
+    Returns the projected first left view and the aggregated NCC map.
+    """
+    preprocess, compute = NCC_ENGINES[engine]
+    pixels = width * height
+
+    with stage(timer, 'warp', pixels):
+        map_x, map_y = warp_maps(H, width, height)
+
+    scores = np.empty((len(lefts), height, width), dtype=np.float32)
+    projected = None
+    for i, (left, right_normalized) in enumerate(zip(lefts,
+                                                     rights_normalized)):
+        with stage(timer, 'warp', pixels):
+            projected_left = cv2.remap(left, map_x, map_y, cv2.INTER_LINEAR)
+        with stage(timer, 'preprocess', pixels):
+            left_normalized = preprocess(projected_left, ncc_size)
+        with stage(timer, 'ncc', pixels):
+            scores[i] = compute(right_normalized, left_normalized)
+        if projected is None:
+            projected = projected_left
+
+    with stage(timer, 'aggregate', pixels * len(lefts)):
+        ncc = aggregate_ncc(scores, aggregate)
+
+    return projected, ncc
+
+
+class StreamingArgmax(object):
+    """
+    Running argmax over a sequence of height x width score maps.  This gives
+    the same labels as stacking every map into a cost volume and calling
+    argmax(axis=2), but memory stays constant in the number of layers.
+
+    With second_best=True the runner-up score is tracked as well, so that
+    confidence() can report the margin between the two best layers.
+    """
+
+    def __init__(self, height, width, second_best=False):
+        self.best = np.full((height, width), -np.inf, dtype=np.float32)
+        self.label = np.zeros((height, width), dtype=np.int64)
+        self.second = None
+        if second_best:
+            self.second = np.full((height, width), -np.inf, dtype=np.float32)
+
+    def update(self, label, score):
+        # Strict comparison keeps the first maximum, as argmax does.
+        better = score > self.best
+        if self.second is not None:
+            runner_up = np.where(better, self.best,
+                                 np.maximum(self.second, score))
+            np.copyto(self.second, runner_up, casting='unsafe')
+        np.copyto(self.best, score, casting='unsafe', where=better)
+        self.label[better] = label
+
+    def confidence(self):
+        assert self.second is not None
+        margin = self.best - self.second
+        margin[~np.isfinite(margin)] = 0
+        return margin
+
+
 def get_depths(data):
     min_depth = data.min_depth
     max_depth = data.max_depth
@@ -132,9 +769,38 @@ def pyrup(image):
     return pyrup_impl(image)
 
 
-def save_mesh(K, width, height, albedo, normals, depth, alpha, filename):
+Mesh = namedtuple('Mesh', ['vertices', 'normals', 'colors', 'faces'])
+
+
+def build_mesh(K, width, height, albedo, normals, depth, alpha,
+               triangles=False):
+    """
+    Build a mesh from a depth map with one vertex per pixel inside alpha
+    and one quad per 2x2 block of such pixels, entirely with array
+    operations.
+
+    Input:
+        K -- camera intrinsics or a camera.Camera to unproject the pixels
+             with; with None a vertex is (x, y, depth)
+        width, height -- size of the depth map
+        albedo -- height x width x channels vertex colors, scaled so that
+                  the brightest becomes 255, or None for white.  Grayscale
+                  albedo, with one or no channel axis, is repeated into RGB.
+        normals -- height x width x 3 normals, which the mesh stores
+                   negated, or None for (0, 0, -1) everywhere
+        depth -- height x width depth map
+        alpha -- height x width mask of the pixels to keep
+        triangles -- split every quad into two triangles
+    Output:
+        Mesh with vertices and normals (V x 3), colors (V x 3 uint8) and
+        faces (F x 4, or F x 3 with triangles) of vertex indices.  Vertices
+        are numbered in row-major pixel order, and the corners of a face go
+        (x, y), (x, y + 1), (x + 1, y + 1), (x + 1, y).
+    """
     if albedo is not None:
         albedo = np.uint8(255.0 * albedo / albedo.max())
+        if albedo.ndim == 2 or albedo.shape[2] == 1:
+            albedo = np.repeat(albedo.reshape(height, width, 1), 3, axis=2)
     else:
         albedo = 255 * np.ones((height, width, 3), dtype=np.uint8)
 
@@ -146,57 +812,108 @@ def save_mesh(K, width, height, albedo, normals, depth, alpha, filename):
 
     if K is None:
         invK = None
+    elif isinstance(K, Camera):
+        invK = K.K_inv
     else:
         invK = np.linalg.inv(K)
 
-    indices = np.nan * np.ones((height, width), dtype=np.float32)
-    index = 0
-    vertices = []
-    for h in range(height):
-        for w in range(width):
-            if alpha[h, w]:
-                indices[h, w] = index
-                point = np.array(((w, ), (h, ), (1, )), dtype=np.float32)
-                if invK is not None:
-                    point = invK.dot(point)
-                    point *= depth[h, w]
-                else:
-                    point[-1] *= depth[h, w]
-                vertices.append('%f %f %f %f %f %f %d %d %d' % (
-                    tuple(point.flatten().tolist()) +
-                    tuple(normals[h, w, :].flatten().tolist()) +
-                    tuple(albedo[h, w, :3].flatten().tolist())))
-                index += 1
-
-    faces = []
-    for h in range(height - 1):
-        for w in range(width - 1):
-            index1 = indices[h, w]
-            index2 = indices[h + 1, w]
-            index3 = indices[h + 1, w + 1]
-            index4 = indices[h, w + 1]
-            corners = np.array((index1, index2, index3, index4))
-            if not np.isnan(corners).any():
-                faces.append('4 %d %d %d %d' %
-                             (index1, index2, index3, index4))
+    valid = alpha[:height, :width] != 0
+    rows, cols = np.nonzero(valid)
+
+    points = np.float32(np.stack((cols, rows, np.ones_like(rows)), axis=1))
+    if invK is not None:
+        points = points.dot(invK.T) * depth[rows, cols][:, np.newaxis]
+    else:
+        points[:, 2] *= depth[rows, cols]
+
+    indices = np.cumsum(valid.ravel()).reshape(height, width) - 1
+    quads = valid[:-1, :-1] & valid[1:, :-1] & valid[1:, 1:] & \
+        valid[:-1, 1:]
+    faces = np.stack((indices[:-1, :-1][quads], indices[1:, :-1][quads],
+                      indices[1:, 1:][quads], indices[:-1, 1:][quads]),
+                     axis=1)
+    if triangles:
+        faces = faces[:, [0, 1, 2, 0, 2, 3]].reshape(-1, 3)
+
+    return Mesh(np.float64(points), normals[rows, cols],
+                albedo[rows, cols, :3], faces)
+
+
+def _ply_header(format, vertex_count, face_count):
+    return ('ply\n'
+            'format {0} 1.0\n'
+            'element vertex {1}\n'
+            'property float x\n'
+            'property float y\n'
+            'property float z\n'
+            'property float nx\n'
+            'property float ny\n'
+            'property float nz\n'
+            'property uchar diffuse_red\n'
+            'property uchar diffuse_green\n'
+            'property uchar diffuse_blue\n'
+            'element face {2}\n'
+            'property list uint8 int32 vertex_index\n'
+            'end_header\n').format(format, vertex_count, face_count)
+
+
+_PLY_VERTEX = np.dtype([
+    ('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+    ('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4'),
+    ('diffuse_red', 'u1'), ('diffuse_green', 'u1'), ('diffuse_blue', 'u1'),
+])
+
+
+def _write_binary_ply(filename, mesh):
+    vertices = np.empty(len(mesh.vertices), dtype=_PLY_VERTEX)
+    for i, name in enumerate(('x', 'y', 'z')):
+        vertices[name] = mesh.vertices[:, i]
+    for i, name in enumerate(('nx', 'ny', 'nz')):
+        vertices[name] = mesh.normals[:, i]
+    for i, name in enumerate(('diffuse_red', 'diffuse_green',
+                              'diffuse_blue')):
+        vertices[name] = mesh.colors[:, i]
+
+    corners = mesh.faces.shape[1]
+    faces = np.empty(len(mesh.faces), dtype=np.dtype(
+        [('count', 'u1'), ('vertex_index', '<i4', (corners,))]))
+    faces['count'] = corners
+    faces['vertex_index'] = mesh.faces
+
+    with open(filename, 'wb') as f:
+        f.write(_ply_header('binary_little_endian', len(vertices),
+                            len(faces)).encode('ascii'))
+        vertices.tofile(f)
+        faces.tofile(f)
+
+
+def _write_ascii_ply(filename, mesh):
+    vertices = ['%f %f %f %f %f %f %d %d %d' % (tuple(point) +
+                                                 tuple(normal) + tuple(color))
+                for point, normal, color in zip(mesh.vertices.tolist(),
+                                                mesh.normals.tolist(),
+                                                mesh.colors.tolist())]
+    face = ' '.join(['%d'] * (mesh.faces.shape[1] + 1))
+    faces = [face % ((len(corners),) + tuple(corners))
+             for corners in mesh.faces.tolist()]
 
     with open(filename, 'w') as f:
-        f.write('ply\n')
-        f.write('format ascii 1.0\n')
-        f.write('element vertex %d\n' % len(vertices))
-        f.write('property float x\n')
-        f.write('property float y\n')
-        f.write('property float z\n')
-        f.write('property float nx\n')
-        f.write('property float ny\n')
-        f.write('property float nz\n')
-        f.write('property uchar diffuse_red\n')
-        f.write('property uchar diffuse_green\n')
-        f.write('property uchar diffuse_blue\n')
-        f.write('element face %d\n' % len(faces))
-        f.write('property list uint8 int32 vertex_index\n')
-        f.write('end_header\n')
+        f.write(_ply_header('ascii', len(vertices), len(faces)))
 
         f.write('\n'.join(vertices))
         f.write('\n')
         f.write('\n'.join(faces))
+
+
+def save_mesh(K, width, height, albedo, normals, depth, alpha, filename,
+              binary=False, triangles=False):
+    """
+    Save the mesh from build_mesh as a PLY file, binary_little_endian with
+    binary=True and ASCII otherwise.
+    """
+    mesh = build_mesh(K, width, height, albedo, normals, depth, alpha,
+                      triangles)
+    if binary:
+        _write_binary_ply(filename, mesh)
+    else:
+        _write_ascii_ply(filename, mesh)